@@ -38,6 +38,10 @@ echo ">>> Running Django migrations..."
 python manage.py makemigrations --noinput || true
 python manage.py makemigrations tgbot --noinput || true
 python manage.py migrate --noinput
+python manage.py rebuild_complaint_stats
+
+echo ">>> Compiling location snapshot..."
+python manage.py build_locations
 
 echo ">>> Collecting static files..."
 python manage.py collectstatic --noinput
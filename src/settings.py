@@ -86,12 +86,48 @@ if env.bool("USE_SQLITE", default=False):
 else:
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'ENGINE': 'django.db.backends.postgresql',
             "NAME": env.str("POSTGRES_DB"),
             "USER": env.str("POSTGRES_USER"),
             "PASSWORD": env.str("POSTGRES_PASSWORD"),
             "HOST": env.str("POSTGRES_HOST", "db"),
             "PORT": env.int("POSTGRES_PORT", 5432),
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+
+    # Connection pool per process. DB_ROLE=bot for `runbot` (supervisord sets
+    # it): the async ORM thread plus the DB_EXECUTOR_WORKERS pool threads.
+    # DB_ROLE=web for each gunicorn worker: one connection per thread.
+    # DB_POOL=False falls back to persistent connections (CONN_MAX_AGE).
+    DB_ROLE = env.str("DB_ROLE", "web")
+    if env.bool("DB_POOL", default=True):
+        DATABASES['default']["OPTIONS"] = {
+            "pool": {
+                "min_size": env.int("DB_POOL_MIN_SIZE", 1),
+                "max_size": env.int(
+                    "DB_POOL_MAX_SIZE",
+                    env.int("DB_EXECUTOR_WORKERS", 4) + 1 if DB_ROLE == "bot" else 2
+                ),
+                "timeout": env.float("DB_POOL_TIMEOUT", 10),
+            },
+        }
+    else:
+        DATABASES['default']["CONN_MAX_AGE"] = env.int("CONN_MAX_AGE", 60)
+
+# Cache
+# Shared through Redis when it is configured, so the bot sees invalidations
+# made by the admin; otherwise each process keeps its own.
+
+REDIS_URL = env.str("REDIS_URL", "") or (
+    f"redis://{env.str('REDIS_HOST')}:{env.int('REDIS_PORT', 6379)}/{env.int('REDIS_DB', 0)}"
+    if env.str("REDIS_HOST", "") else ""
+)
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
         }
     }
 
@@ -1,13 +1,17 @@
 from django.contrib import admin
-from django.utils.html import format_html
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.db.models import Count, OuterRef, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html, format_html_join
 from django.urls import reverse
 from .models import Complaint
 import openpyxl
-from django.http import HttpResponse
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
-from django.http import HttpResponse
 import csv
-from datetime import datetime
+import tempfile
 from .models import TelegramUser, Complaint, ComplaintMedia, BroadcastMessage
 import zipfile
 import io
@@ -15,6 +19,55 @@ import os
 from django.conf import settings 
 import requests 
 from django.utils import timezone 
+from .changelist import ComplaintChangeList, DistrictFilter, EstimatedCountPaginator, RegionFilter
+from .search import highlight, search_complaints
+
+EXPORT_CHUNK_SIZE = 2000
+XLSX_SPOOL_SIZE = 8 * 1024 * 1024
+
+EXPORT_FIELDS = (
+    'id', 'number', 'created_at', 'status', 'is_anonymous', 'full_name', 'phone_number',
+    'region_name', 'district_name', 'street_name', 'target_full_name', 'target_position',
+    'target_organization', 'complaint_text',
+)
+
+EXPORT_HEADERS = [
+    'ID', 'Number', 'Created At', 'Status', 'Is Anonymous', 'Full Name', 'Phone',
+    'Region', 'District', 'Mahalla', 'Target Name', 'Target Position',
+    'Target Organization', 'Complaint Text'
+]
+
+
+def export_rows(queryset):
+    """Yield the export columns of every complaint in ``queryset`` without loading model instances."""
+    status_names = dict(Complaint.STATUS_CHOICES)
+    rows = queryset.order_by('-created_at', '-id').values_list(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for (complaint_id, number, created_at, status, is_anonymous, full_name, phone_number, region_name,
+         district_name, street_name, target_full_name, target_position, target_organization, complaint_text) in rows:
+        yield [
+            complaint_id,
+            number or '-',
+            timezone.localtime(created_at).strftime('%Y-%m-%d %H:%M:%S'),
+            str(status_names.get(status, status)),
+            'Yes' if is_anonymous else 'No',
+            full_name or '-',
+            phone_number or '-',
+            region_name,
+            district_name,
+            street_name or '-',
+            target_full_name,
+            target_position,
+            target_organization,
+            complaint_text
+        ]
+
+
+class Echo:
+    """Pseudo-buffer for csv.writer: write() hands the line back instead of storing it."""
+
+    def write(self, value):
+        return value
+
 
 def send_telegram_status_update(telegram_id, message_text):
     """Berilgan Telegram IDga xabar yuborish uchun funksiya."""
@@ -61,8 +114,19 @@ def send_telegram_status_update(telegram_id, message_text):
 #     full_name_display.short_description = _('Full Name')
 
 
+class ComplaintMediaFormSet(BaseInlineFormSet):
+
+    def get_queryset(self):
+        # Reuse the media prefetched with the complaint instead of reading them again
+        prefetched = getattr(self.instance, '_prefetched_objects_cache', {}).get('media_files')
+        if prefetched is not None:
+            return prefetched
+        return super().get_queryset()
+
+
 class ComplaintMediaInline(admin.TabularInline):
     model = ComplaintMedia
+    formset = ComplaintMediaFormSet
     extra = 0
     readonly_fields = ['file_type', 'file_id', 'file_name', 'created_at']
     can_delete = False
@@ -76,6 +140,7 @@ class ComplaintAdmin(admin.ModelAdmin):
 
     list_display = [
         'id',
+        'number',
         'created_at',
         'status_badge',
         # 'user_display',
@@ -83,16 +148,21 @@ class ComplaintAdmin(admin.ModelAdmin):
         'region_name',
         'district_name',
         'target_full_name',
+        'media_count',
         'view_details_link'
     ]
     list_filter = [
         'status',
         'is_anonymous',
         'created_at',
-        'region_name',
+        RegionFilter,
+        DistrictFilter,
     ]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     search_fields = [
         'id',
+        '=number',
         'full_name',
         'phone_number',
         'target_full_name',
@@ -101,6 +171,7 @@ class ComplaintAdmin(admin.ModelAdmin):
     ]
     readonly_fields = [
         'user',
+        'number',
         'created_at',
         'updated_at',
         'full_address_display',
@@ -109,7 +180,7 @@ class ComplaintAdmin(admin.ModelAdmin):
 
     fieldsets = (
         (_('Status'), {
-            'fields': ('status', 'admin_notes')
+            'fields': ('number', 'status', 'admin_notes')
         }),
         # (_('Reporter Information'), {
         #     'fields': ('user', 'is_anonymous', 'full_name', 'phone_number', 'telegram_username')
@@ -130,7 +201,45 @@ class ComplaintAdmin(admin.ModelAdmin):
     )
 
     inlines = [ComplaintMediaInline]
-    actions = ['export_to_csv', 'mark_in_progress', 'mark_resolved', 'mark_rejected']
+    actions = ['export_to_csv', 'export_to_excel', 'mark_in_progress', 'mark_resolved', 'mark_rejected']
+
+    def get_changelist(self, request, **kwargs):
+        return ComplaintChangeList
+
+    def get_queryset(self, request):
+        # Counted per displayed row, so a page costs the same however large the table is
+        media_count = (
+            ComplaintMedia.objects
+            .filter(complaint=OuterRef('pk'))
+            .order_by()
+            .values('complaint')
+            .annotate(count=Count('pk'))
+            .values('count')
+        )
+        return super().get_queryset(request).annotate(media_count=Coalesce(Subquery(media_count), 0))
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            # One read serves both media_files_display and the inline
+            prefetch_related_objects([obj], 'media_files')
+        return obj
+
+    def get_search_results(self, request, queryset, search_term):
+        results = search_complaints(queryset, search_term)
+        if results is None:
+            return super().get_search_results(request, queryset, search_term)
+        return results, False
+
+    def get_list_display(self, request):
+        list_display = super().get_list_display(request)
+        if request.GET.get(SEARCH_VAR, '').strip():
+            return [*list_display[:-1], 'search_highlight', list_display[-1]]
+        return list_display
+
+    def search_highlight(self, obj):
+        return highlight(getattr(obj, 'search_headline', None))
+    search_highlight.short_description = _('Match')
 
     def status_badge(self, obj):
         colors = {
@@ -165,62 +274,78 @@ class ComplaintAdmin(admin.ModelAdmin):
         return obj.get_full_address()
     full_address_display.short_description = _('Full Address')
 
+    def media_count(self, obj):
+        return obj.media_count
+    media_count.short_description = _('Media')
+    media_count.admin_order_field = 'media_count'
+
     def media_files_display(self, obj):
         media = obj.media_files.all()
         if not media:
             return _('No media files')
 
-        html = '<ul style="margin: 0; padding-left: 20px;">'
-        for item in media:
-            html += f'<li>{item.get_file_type_display()}: {item.file_id}</li>'
-        html += '</ul>'
-        return format_html(html)
+        return format_html(
+            '<ul style="margin: 0; padding-left: 20px;">{}</ul>',
+            format_html_join('', '<li>{}: {}</li>', ((item.get_file_type_display(), item.file_id) for item in media))
+        )
     media_files_display.short_description = _('Media Files')
 
+    def export_filename(self, extension):
+        return f'complaints_{timezone.localtime().strftime("%Y%m%d_%H%M%S")}.{extension}'
+
     def export_to_csv(self, request, queryset):
-        """Export selected complaints to CSV"""
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
-        response['Content-Disposition'] = f'attachment; filename="complaints_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv"'
-        response.write('\ufeff')  
-
-        writer = csv.writer(response)
-        writer.writerow([
-            'ID', 'Created At', 'Status', 'Is Anonymous', 'Full Name', 'Phone',
-            'Region', 'District', 'Mahalla', 'Target Name', 'Target Position',
-            'Target Organization', 'Complaint Text'
-        ])
-
-        for complaint in queryset:
-            writer.writerow([
-                complaint.id,
-                complaint.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                complaint.get_status_display(),
-                'Yes' if complaint.is_anonymous else 'No',
-                complaint.full_name or '-',
-                complaint.phone_number or '-',
-                complaint.region_name,
-                complaint.district_name,
-                complaint.street_name or '-',
-                complaint.target_full_name,
-                complaint.target_position,
-                complaint.target_organization,
-                complaint.complaint_text
-            ])
+        """Export selected complaints to CSV, streamed row by row"""
+        writer = csv.writer(Echo())
+
+        def lines():
+            yield '\ufeff'
+            yield writer.writerow(EXPORT_HEADERS)
+            for row in export_rows(queryset):
+                yield writer.writerow(row)
 
+        response = StreamingHttpResponse(lines(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{self.export_filename("csv")}"'
         return response
     export_to_csv.short_description = _('Export selected complaints to CSV')
 
+    def export_to_excel(self, request, queryset):
+        """Export selected complaints to Excel.
+
+        The write-only workbook streams rows to disk as they are appended,
+        and the finished file is spooled to a temporary file and sent from
+        there.
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet("Complaints")
+        worksheet.append(EXPORT_HEADERS)
+        for row in export_rows(queryset):
+            worksheet.append([
+                ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value
+                for value in row
+            ])
+
+        output = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE)
+        workbook.save(output)
+        output.seek(0)
+        return FileResponse(
+            output,
+            as_attachment=True,
+            filename=self.export_filename('xlsx'),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+    export_to_excel.short_description = _('Export selected complaints to Excel')
+
     def mark_in_progress(self, request, queryset):
         """Mark selected complaints as in progress and notify user"""
         updated_count = 0
         
-        for complaint in queryset:
+        for complaint in queryset.select_related('user'):
             complaint.status = 'in_progress'
             complaint.save(update_fields=['status', 'updated_at'])
             updated_count += 1
             
             if complaint.user and complaint.user.telegram_id:
-                message = f"⏳ **Ariza holati yangilandi**\n\nSizning **№{complaint.id}** raqamli arizangiz **ko'rib chiqilmoqda** (jarayonda). Iltimos, yakuniy natijani kuting."
+                message = f"⏳ **Ariza holati yangilandi**\n\nSizning **№{complaint.number or complaint.id}** raqamli arizangiz **ko'rib chiqilmoqda** (jarayonda). Iltimos, yakuniy natijani kuting."
                 send_telegram_status_update(complaint.user.telegram_id, message)
         
         self.message_user(request, f'{updated_count} ta ariza "Jarayonda" deb belgilandi va foydalanuvchilarga xabar berildi.')
@@ -231,14 +356,14 @@ class ComplaintAdmin(admin.ModelAdmin):
         updated_count = 0
         now = timezone.now() 
         
-        for complaint in queryset:
+        for complaint in queryset.select_related('user'):
             complaint.status = 'resolved'
             complaint.resolved_at = now
             complaint.save(update_fields=['status', 'resolved_at', 'updated_at'])
             updated_count += 1
             
             if complaint.user and complaint.user.telegram_id:
-                message = f"✅ **Ariza hal qilindi**\n\nSizning **№{complaint.id}** raqamli arizangiz **muvaffaqiyatli hal qilindi**. E'tiboringiz uchun rahmat."
+                message = f"✅ **Ariza hal qilindi**\n\nSizning **№{complaint.number or complaint.id}** raqamli arizangiz **muvaffaqiyatli hal qilindi**. E'tiboringiz uchun rahmat."
                 send_telegram_status_update(complaint.user.telegram_id, message)
         
         self.message_user(request, f'{updated_count} ta ariza "Hal qilindi" deb belgilandi va foydalanuvchilarga xabar berildi.')
@@ -248,13 +373,13 @@ class ComplaintAdmin(admin.ModelAdmin):
         """Mark selected complaints as rejected and notify user"""
         updated_count = 0
         
-        for complaint in queryset:
+        for complaint in queryset.select_related('user'):
             complaint.status = 'rejected'
             complaint.save(update_fields=['status', 'updated_at'])
             updated_count += 1
             
             if complaint.user and complaint.user.telegram_id:
-                message = f"❌ **Ariza rad etildi**\n\nUzr, sizning **№{complaint.id}** raqamli arizangiz **rad etildi**."
+                message = f"❌ **Ariza rad etildi**\n\nUzr, sizning **№{complaint.number or complaint.id}** raqamli arizangiz **rad etildi**."
                 send_telegram_status_update(complaint.user.telegram_id, message)
         
         self.message_user(request, f'{updated_count} ta ariza "Rad etildi" deb belgilandi va foydalanuvchilarga xabar berildi.')
@@ -267,11 +392,12 @@ class ComplaintMediaAdmin(admin.ModelAdmin):
     list_filter = ['file_type', 'created_at']
     search_fields = ['complaint__id', 'file_id', 'file_name']
     readonly_fields = ['complaint', 'file_id', 'file_type', 'file_name', 'created_at']
+    list_select_related = ['complaint']
     actions = ['download_selected_as_zip']
 
     def complaint_link(self, obj):
-        url = reverse('admin:tgbot_complaint_change', args=[obj.complaint.id])
-        return format_html('<a href="{}">Complaint #{}</a>', url, obj.complaint.id)
+        url = reverse('admin:tgbot_complaint_change', args=[obj.complaint_id])
+        return format_html('<a href="{}">Complaint #{}</a>', url, obj.complaint.number or obj.complaint_id)
     complaint_link.short_description = _('Complaint')
 
     def download_selected_as_zip(self, request, queryset):
@@ -299,10 +425,12 @@ class ComplaintMediaAdmin(admin.ModelAdmin):
 @admin.register(BroadcastMessage)
 class BroadcastMessageAdmin(admin.ModelAdmin):
 
-    list_display = ['id', 'created_at', 'created_by', 'sent_count', 'failed_count', 'status_display']
+    list_display = ['id', 'created_at', 'created_by', 'total_count', 'sent_count', 'failed_count', 'status_display']
     list_filter = ['created_at']
     search_fields = ['text', 'created_by']
-    readonly_fields = ['sent_count', 'failed_count', 'created_at', 'completed_at']
+    readonly_fields = [
+        'total_count', 'sent_count', 'failed_count', 'last_user_id', 'chat_id', 'created_at', 'completed_at'
+    ]
 
     def status_display(self, obj):
         """Display broadcast status"""
@@ -314,37 +442,3 @@ class BroadcastMessageAdmin(admin.ModelAdmin):
             '<span style="color: orange;">⏳ In Progress</span>'
         )
     status_display.short_description = _('Status')
-@admin.action(description="Tanlangan shikoyatlarni Excel faylga yuklab olish")
-def export_to_excel(modeladmin, request, queryset):
-    workbook = openpyxl.Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Complaints"
-
-    # 2. Sarlavhalar (ustun nomlari)
-    columns = [
-        'ID', 'To‘liq ism', 'Telefon raqami', 'Viloyat', 'Tuman', 'Mahalla',
-        'Kimga qarshi', 'Lavozimi', 'Tashkiloti', 'Shikoyat matni', 'Yaratilgan sana'
-    ]
-    worksheet.append(columns)
-
-    # 3. Har bir yozuvni jadvalga yozish
-    for obj in queryset:
-        worksheet.append([
-            obj.id,
-            obj.full_name,
-            obj.phone_number,
-            obj.region,
-            obj.district,
-            obj.mahalla,
-            obj.target_full_name,
-            obj.target_position,
-            obj.target_organization,
-            obj.complaint_text,
-            obj.created_at.strftime("%Y-%m-%d %H:%M"),
-        ])
-    response = HttpResponse(
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    )
-    response['Content-Disposition'] = 'attachment; filename=complaints.xlsx'
-    workbook.save(response)
-    return response
\ No newline at end of file
@@ -0,0 +1,267 @@
+"""Broadcasts to every active bot user.
+
+Recipients are read in id order, BROADCAST_BATCH_SIZE at a time, and sent
+by BROADCAST_CONCURRENCY workers. Every broadcast draws from one shared
+token bucket of BROADCAST_RATE messages per second - Telegram lets a bot
+send about 30 - and a ``TelegramRetryAfter`` pauses the whole bucket for
+as long as Telegram asks before the message is sent again.
+
+Progress is checkpointed into the BroadcastMessage row every
+BROADCAST_CHECKPOINT_INTERVAL seconds: the counts and ``last_user_id``,
+the id up to which every recipient has been handled. Users who blocked
+the bot are marked in the same transaction with one UPDATE. After a
+restart ``resume_unfinished`` carries on from the checkpoint, so only
+the messages sent since the last checkpoint go out twice.
+"""
+import asyncio
+import collections
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from tgbot.bot import repository
+from tgbot.bot.keyboards.reply import admin_keyboard
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv('BROADCAST_CHECKPOINT_INTERVAL', '5'))
+# Network and server errors are retried this many times, flood waits always
+BROADCAST_ATTEMPTS = 3
+
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+class RateLimiter:
+    """Token bucket of ``rate`` sends per second with ``burst`` at once.
+
+    Kept in GCRA form like ThrottlingMiddleware: one theoretical arrival
+    time on the monotonic clock. Each caller reserves the next slot and
+    sleeps until it comes, so no lock is needed. ``pause()`` holds back
+    every send, including callers already waiting for a slot.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.arrival = 0.0
+        self.resume_at = 0.0
+        self.pauses = 0
+
+    def reserve(self, now: float = None) -> float:
+        """Take the next slot and return how many seconds until it is due."""
+        if now is None:
+            now = time.monotonic()
+        arrival = max(self.arrival, now)
+        self.arrival = arrival + self.interval
+        return max(arrival - self.tolerance - now, 0.0)
+
+    def pause(self, seconds: float, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        self.pauses += 1
+        self.resume_at = max(self.resume_at, now + seconds)
+        # No burst right after a pause
+        self.arrival = max(self.arrival, self.resume_at + self.tolerance)
+
+    async def acquire(self):
+        while True:
+            delay = self.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            # Slots taken before a pause are given up and taken again after it
+            paused = self.resume_at - time.monotonic()
+            if paused <= 0:
+                return
+            await asyncio.sleep(paused)
+
+
+limiter = RateLimiter()
+
+
+class Broadcast:
+    """Send one BroadcastMessage to the active users it has not reached yet."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        record,
+        limiter: RateLimiter = limiter,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        batch_size: int = BROADCAST_BATCH_SIZE,
+        checkpoint_interval: float = BROADCAST_CHECKPOINT_INTERVAL,
+    ):
+        self.bot = bot
+        self.id = record.pk
+        self.text = record.text
+        self.total = record.total_count
+        self.last_user_id = record.last_user_id
+        self.sent = record.sent_count
+        self.failed = record.failed_count
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.completed = False
+        self._blocked = []
+        # [user id, outcome] in id order; outcome is None while in flight
+        self._window = collections.deque()
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    async def send(self, chat_id):
+        attempts = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.text)
+                return SENT
+            except TelegramRetryAfter as e:
+                logger.warning("Broadcast #%s hit flood control, pausing for %ss", self.id, e.retry_after)
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempts += 1
+                if attempts >= BROADCAST_ATTEMPTS:
+                    logger.info("Broadcast #%s to %s failed: %s", self.id, chat_id, e)
+                    return FAILED
+                await asyncio.sleep(attempts)
+            except TelegramAPIError as e:
+                logger.info("Broadcast #%s to %s failed: %s", self.id, chat_id, e)
+                return FAILED
+
+    async def _work(self, queue):
+        while (item := await queue.get()) is not None:
+            entry, chat_id = item
+            try:
+                entry[1] = await self.send(chat_id)
+            except Exception:
+                logger.exception("Broadcast #%s to %s failed", self.id, chat_id)
+                entry[1] = FAILED
+
+    def _advance(self):
+        # Move the checkpoint over the finished prefix of the window
+        while self._window and self._window[0][1] is not None:
+            user_id, outcome = self._window.popleft()
+            self.last_user_id = user_id
+            if outcome == SENT:
+                self.sent += 1
+            else:
+                self.failed += 1
+                if outcome == BLOCKED:
+                    self._blocked.append(user_id)
+
+    async def checkpoint(self, completed=False):
+        self._advance()
+        blocked, self._blocked = self._blocked, []
+        try:
+            await repository.run_sync(
+                repository.checkpoint_broadcast,
+                self.id, self.last_user_id, self.sent, self.failed, blocked, completed
+            )
+        except BaseException:
+            self._blocked = blocked + self._blocked
+            raise
+
+    async def _checkpoint_forever(self, progress):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+                if progress is not None:
+                    await progress(self)
+            except Exception:
+                logger.exception("Could not checkpoint broadcast #%s", self.id)
+
+    async def run(self, progress=None):
+        """Send to every remaining user; ``progress(self)`` is awaited after each checkpoint."""
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._work(queue)) for _ in range(self.concurrency)]
+        checkpointer = asyncio.ensure_future(self._checkpoint_forever(progress))
+        try:
+            after_id = self.last_user_id
+            while batch := await repository.run_sync(repository.broadcast_recipients, after_id, self.batch_size):
+                for user_id, chat_id in batch:
+                    entry = [user_id, None]
+                    self._window.append(entry)
+                    await queue.put((entry, chat_id))
+                after_id = batch[-1][0]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            self.completed = True
+        finally:
+            checkpointer.cancel()
+            for worker in workers:
+                worker.cancel()
+            # Also saves what was sent before a shutdown or an error
+            await self.checkpoint(completed=self.completed)
+        return self
+
+
+_tasks = set()
+
+
+def start(bot: Bot, record, status_message=None):
+    """Run ``record`` in the background and report the result to its admin chat."""
+    task = asyncio.create_task(run_broadcast(bot, record, status_message))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def stop():
+    """Cancel the running broadcasts and wait for their last checkpoint."""
+    tasks = list(_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_broadcast(bot: Bot, record, status_message=None):
+    async def progress(broadcast):
+        if status_message is None:
+            return
+        try:
+            await status_message.edit_text(f"⏳ Xabar yuborilmoqda... {broadcast.done}/{broadcast.total}")
+        except Exception:
+            logger.debug("Could not update broadcast progress", exc_info=True)
+
+    try:
+        broadcast = await Broadcast(bot, record).run(progress)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception("Broadcast #%s stopped", record.pk)
+        await bot.send_message(record.chat_id, f"❌ Xabar yuborishda xatolik: {e}")
+        return
+
+    await bot.send_message(
+        record.chat_id,
+        f"✅ <b>Xabar yuborish yakunlandi</b>\n\n"
+        f"📊 Yuborildi: {broadcast.sent}\n"
+        f"❌ Yuborilmadi: {broadcast.failed}\n"
+        f"👥 Jami foydalanuvchilar: {broadcast.total}",
+        reply_markup=admin_keyboard()
+    )
+
+
+async def resume_unfinished(bot: Bot):
+    """Restart the broadcasts a previous run did not finish."""
+    records = await repository.unfinished_broadcasts()
+    for record in records:
+        logger.info("Resuming broadcast #%s after user %s", record.pk, record.last_user_id)
+        start(bot, record)
+    return len(records)
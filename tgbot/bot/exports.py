@@ -0,0 +1,225 @@
+"""Complaint export for the admin panel.
+
+Rows are streamed from the database in chunks straight into a zipped CSV
+held in a spooled temporary file. Once the compressed part reaches
+EXPORT_PART_SIZE it is closed and handed over for sending, and the next
+rows go into a new part; each part is a complete archive with its own
+header row. Memory use therefore does not grow with the table.
+"""
+import asyncio
+import concurrent.futures
+import csv
+import io
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+
+from aiogram import Bot
+from aiogram.types import InputFile
+from django.utils import timezone
+
+from tgbot.bot import repository
+from tgbot.models import Complaint
+
+logger = logging.getLogger(__name__)
+
+# Telegram bots may upload at most 50 MB per file
+EXPORT_PART_SIZE = int(os.getenv('EXPORT_PART_SIZE', 45 * 1024 * 1024))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))
+EXPORT_PROGRESS_INTERVAL = float(os.getenv('EXPORT_PROGRESS_INTERVAL', '3'))
+SPOOL_SIZE = 8 * 1024 * 1024
+
+HEADERS = [
+    'ID',
+    'Raqami',
+    'Yaratilgan sana',
+    'Holati',
+    'Anonim',
+    'Arizachi F.I.SH.',
+    'Telefon raqami',
+    'Telegram',
+    'Viloyat',
+    'Tuman (Shahar)',
+    'Mahalla',
+    'Ayblanuvchi F.I.SH.',
+    'Lavozimi',
+    'Tashkilot',
+    'Shikoyat matni',
+    'Yechim sanasi'
+]
+
+FIELDS = (
+    'id', 'number', 'created_at', 'status', 'is_anonymous', 'full_name', 'phone_number',
+    'telegram_username', 'region_name', 'district_name', 'street_name', 'target_full_name',
+    'target_position', 'target_organization', 'complaint_text', 'resolved_at',
+)
+
+STATUS_NAMES = dict(Complaint.STATUS_CHOICES)
+
+
+def _format_date(value):
+    return timezone.localtime(value).strftime('%d.%m.%Y %H:%M:%S') if value else '-'
+
+
+def format_row(row):
+    (complaint_id, number, created_at, status, is_anonymous, full_name, phone_number,
+     telegram_username, region_name, district_name, street_name, target_full_name,
+     target_position, target_organization, complaint_text, resolved_at) = row
+    return [
+        complaint_id,
+        number or '-',
+        _format_date(created_at),
+        str(STATUS_NAMES.get(status, status)),
+        'Да' if is_anonymous else 'Нет',
+        full_name or '-',
+        phone_number or '-',
+        f"@{telegram_username}" if telegram_username else '-',
+        region_name,
+        district_name,
+        street_name or '-',
+        target_full_name,
+        target_position,
+        target_organization,
+        complaint_text,
+        _format_date(resolved_at),
+    ]
+
+
+class ExportAborted(Exception):
+    pass
+
+
+class ExportPart:
+    """One zipped CSV part being written into a spooled temporary file."""
+
+    def __init__(self, number, stem):
+        self.number = number
+        self.filename = f"{stem}_part{number}.zip"
+        self.rows = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._zip = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._entry = self._zip.open(f"{stem}_part{number}.csv", 'w', force_zip64=True)
+        self._text = io.TextIOWrapper(self._entry, encoding='utf-8', newline='')
+        self._text.write('\ufeff')  # UTF-8 BOM for Excel
+        self.writer = csv.writer(self._text)
+        self.writer.writerow(HEADERS)
+
+    @property
+    def compressed_size(self):
+        return self.file.tell()
+
+    def close(self):
+        self._text.close()
+        self._zip.close()
+        self.file.seek(0)
+
+
+def write_parts(emit, progress, stopped, part_size=EXPORT_PART_SIZE, chunk_size=EXPORT_CHUNK_SIZE):
+    """Write every complaint into zipped CSV parts, calling ``emit(part)`` for each.
+
+    Runs in a worker thread. ``progress['rows']`` is updated as rows are
+    written so the caller can report it; setting ``stopped`` aborts.
+    """
+    stem = f"complaints_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}"
+    part = ExportPart(1, stem)
+    try:
+        for row in repository.complaint_rows(FIELDS, chunk_size):
+            part.writer.writerow(format_row(row))
+            part.rows += 1
+            progress['rows'] += 1
+            if part.rows % chunk_size:
+                continue
+            if stopped.is_set():
+                raise ExportAborted()
+            # The compressor buffers internally, so the size lags slightly behind
+            if part.compressed_size >= part_size:
+                part.close()
+                emit(part)
+                part = ExportPart(part.number + 1, stem)
+
+        part.close()
+        emit(part)
+    except BaseException:
+        part.close()
+        part.file.close()
+        raise
+
+
+class SpooledInputFile(InputFile):
+    """Upload an export part straight from its temporary file."""
+
+    def __init__(self, part, **kwargs):
+        super().__init__(filename=part.filename, **kwargs)
+        self.part = part
+
+    async def read(self, bot: Bot):
+        self.part.file.seek(0)
+        while chunk := self.part.file.read(self.chunk_size):
+            yield chunk
+
+
+async def export_complaints(bot: Bot, chat_id: int, status_message, total: int):
+    """Stream the export to ``chat_id`` part by part, editing ``status_message`` with progress."""
+    loop = asyncio.get_running_loop()
+    parts = asyncio.Queue(maxsize=1)
+    progress = {'rows': 0}
+    stopped = threading.Event()
+
+    def emit(part):
+        # Blocks the writer while the previous part is still being uploaded,
+        # so at most two parts exist at a time
+        future = asyncio.run_coroutine_threadsafe(parts.put(part), loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if stopped.is_set():
+                    future.cancel()
+                    raise ExportAborted()
+
+    async def write():
+        try:
+            await repository.run_sync(write_parts, emit, progress, stopped)
+        finally:
+            await parts.put(None)
+
+    async def report():
+        shown = None
+        while True:
+            await asyncio.sleep(EXPORT_PROGRESS_INTERVAL)
+            if progress['rows'] != shown:
+                shown = progress['rows']
+                percent = f" ({shown * 100 // total}%)" if total else ''
+                try:
+                    await status_message.edit_text(f"⏳ CSV fayl yaratilmoqda... {shown}/{total}{percent}")
+                except Exception:
+                    logger.debug("Could not update export progress", exc_info=True)
+
+    writer = asyncio.ensure_future(write())
+    writer.add_done_callback(lambda task: task.cancelled() or task.exception())
+    reporter = asyncio.ensure_future(report())
+    sent = 0
+    try:
+        while (part := await parts.get()) is not None:
+            try:
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=SpooledInputFile(part),
+                    caption=f"📦 {part.number}-qism: {part.rows} ta shikoyat"
+                )
+                sent += 1
+            finally:
+                part.file.close()
+        await writer
+    finally:
+        reporter.cancel()
+        # The writer thread notices within a second and stops
+        stopped.set()
+        while not parts.empty():
+            part = parts.get_nowait()
+            if part is not None:
+                part.file.close()
+
+    return progress['rows'], sent
@@ -1,7 +1,8 @@
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
-from asgiref.sync import sync_to_async
+from aiogram.fsm.storage.base import StorageKey
+import asyncio
 import logging
 import re
 import shutil
@@ -16,7 +17,8 @@ import os
 import zipfile
 from aiogram.types import FSInputFile
 
-from tgbot.models import TelegramUser, Complaint, ComplaintMedia
+from tgbot.bot import repository
+from tgbot.models import TelegramUser
 from tgbot.bot.states.complaint import ComplaintStates
 from tgbot.bot.keyboards.reply import (
     anonymity_keyboard,
@@ -25,24 +27,19 @@ from tgbot.bot.keyboards.reply import (
     media_keyboard,
     confirmation_keyboard,
     main_menu_keyboard,
-    regions_inline_keyboard,
-    districts_inline_keyboard,
-    mahallas_inline_keyboard
+    mahallas_inline_keyboard,
 )
-from tgbot.bot.loader import get_text, location_manager, bot, GROUP_ID
+from tgbot.bot.loader import get_text, location_manager, location_keyboards, bot, dp, GROUP_ID
+from tgbot.bot.middlewares.fsm_cache import CachedFSMContext
 
-from datetime import datetime
 
 logger = logging.getLogger(__name__)
 router = Router()
 
 
 @router.message(F.text.in_(["📝 Подать жалобу", "📝 Shikoyat yuborish"]))
-async def start_complaint(message: Message, state: FSMContext):
-    user = await sync_to_async(TelegramUser.objects.get)(
-        telegram_id=message.from_user.id
-    )
-    lang = user.language
+async def start_complaint(message: Message, state: FSMContext, db_user: TelegramUser = None):
+    lang = db_user.language if db_user else 'ru'
     await state.update_data(language=lang)
     text = get_text(lang, 'anonymity_choice')
     await message.answer(
@@ -132,7 +129,6 @@ async def ask_for_region(message: Message, state: FSMContext):
     lang = data.get('language', 'ru')
 
     text = get_text(lang, 'select_region')
-    regions = location_manager.get_all_regions()
 
     await message.answer(
         text='.',
@@ -140,7 +136,7 @@ async def ask_for_region(message: Message, state: FSMContext):
     )
     await message.answer(
         text,
-        reply_markup=regions_inline_keyboard(regions)
+        reply_markup=location_keyboards.regions()
     )
     await state.set_state(ComplaintStates.region)
 
@@ -159,7 +155,6 @@ async def process_region(callback: CallbackQuery, state: FSMContext):
         region_id=region_id,
         region_name=region['name']
     )
-    districts = location_manager.get_districts_by_region(region_id)
 
     data = await state.get_data()
     lang = data.get('language', 'ru')
@@ -167,7 +162,7 @@ async def process_region(callback: CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         text,
-        reply_markup=districts_inline_keyboard(districts, region_id)
+        reply_markup=location_keyboards.districts(region_id)
     )
 
     await state.set_state(ComplaintStates.district)
@@ -177,11 +172,9 @@ async def process_region(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(ComplaintStates.region, F.data == "back_to_regions")
 @router.callback_query(ComplaintStates.district, F.data == "back_to_regions")
 async def back_to_regions(callback: CallbackQuery, state: FSMContext):
-    regions = location_manager.get_all_regions()
-
     await callback.message.edit_text(
         "Выберите регион / Viloyatni tanlang:",
-        reply_markup=regions_inline_keyboard(regions)
+        reply_markup=location_keyboards.regions()
     )
 
     await state.set_state(ComplaintStates.region)
@@ -201,7 +194,6 @@ async def process_district(callback: CallbackQuery, state: FSMContext):
         district_id=district_id,
         district_name=district['name']
     )
-    mahallas = location_manager.get_streets_by_district(district_id)
 
     data = await state.get_data()
     lang = data.get('language', 'ru')
@@ -209,7 +201,7 @@ async def process_district(callback: CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         text,
-        reply_markup=mahallas_inline_keyboard(mahallas, district_id, page=0)
+        reply_markup=location_keyboards.mahallas(district_id, page=0)
     )
 
     await state.set_state(ComplaintStates.mahalla)
@@ -222,11 +214,9 @@ async def back_to_districts(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     region_id = data.get('region_id')
 
-    districts = location_manager.get_districts_by_region(region_id)
-
     await callback.message.edit_text(
         "Выберите район / Tumanni tanlang:",
-        reply_markup=districts_inline_keyboard(districts, region_id)
+        reply_markup=location_keyboards.districts(region_id)
     )
 
     await state.set_state(ComplaintStates.district)
@@ -239,15 +229,31 @@ async def mahalla_pagination(callback: CallbackQuery, state: FSMContext):
     district_id = int(parts[2])
     page = int(parts[3])
 
-    mahallas = location_manager.get_streets_by_district(district_id)
-
     await callback.message.edit_reply_markup(
-        reply_markup=mahallas_inline_keyboard(mahallas, district_id, page=page)
+        reply_markup=location_keyboards.mahallas(district_id, page=page)
     )
 
     await callback.answer()
 
 
+@router.message(ComplaintStates.mahalla, F.text)
+async def search_mahalla(message: Message, state: FSMContext):
+    data = await state.get_data()
+    lang = data.get('language', 'ru')
+    district_id = data.get('district_id')
+
+    mahallas = location_manager.search_streets(district_id, message.text)
+
+    if not mahallas:
+        await message.answer(get_text(lang, 'mahalla_not_found'))
+        return
+
+    await message.answer(
+        get_text(lang, 'select_mahalla'),
+        reply_markup=mahallas_inline_keyboard(mahallas, district_id)
+    )
+
+
 @router.callback_query(ComplaintStates.mahalla, F.data.startswith("mahalla_"))
 async def process_mahalla(callback: CallbackQuery, state: FSMContext):
     if '_page_' in callback.data:
@@ -331,16 +337,78 @@ async def process_complaint_text(message: Message, state: FSMContext):
     await state.set_state(ComplaintStates.media_files)
 
 
+# Albums arrive as one update per file; their items are buffered per user and
+# media_group_id and appended with a single state write and acknowledgement.
+ALBUM_WINDOW = 0.5
+_pending_albums = {}
+_album_tasks = set()
+
+
+def buffer_album_item(message: Message, state: FSMContext, item: dict):
+    albums = _pending_albums.setdefault(state.key, {})
+    items = albums.get(message.media_group_id)
+    if items is None:
+        items = albums[message.media_group_id] = []
+        task = asyncio.create_task(flush_album(state.key, message.media_group_id, message.chat.id))
+        _album_tasks.add(task)
+        task.add_done_callback(_album_tasks.discard)
+    items.append(item)
+
+
+def pop_album_items(key: StorageKey, media_group_id=None) -> list:
+    albums = _pending_albums.get(key, {})
+    if media_group_id is None:
+        items = [item for group in albums.values() for item in group]
+        albums.clear()
+    else:
+        items = albums.pop(media_group_id, [])
+    if not albums:
+        _pending_albums.pop(key, None)
+    return items
+
+
+async def flush_album(key: StorageKey, media_group_id: str, chat_id: int):
+    await asyncio.sleep(ALBUM_WINDOW)
+
+    async with dp.fsm.events_isolation.lock(key):
+        items = pop_album_items(key, media_group_id)
+        if not items:
+            return
+
+        context = CachedFSMContext(storage=dp.fsm.storage, key=key)
+        if await context.get_state() != ComplaintStates.media_files.state:
+            return
+
+        data = await context.get_data()
+        media_files = data.get('media_files', []) + items
+        await context.update_data(media_files=media_files)
+        await context.flush()
+
+    lang = data.get('language', 'ru')
+    confirm_text = (
+        f"✅ Файлы получены: {len(items)} (всего {len(media_files)})" if lang == 'ru'
+        else f"✅ Fayllar qabul qilindi: {len(items)} (jami {len(media_files)})"
+    )
+    try:
+        await bot.send_message(chat_id=chat_id, text=confirm_text)
+    except Exception:
+        logger.exception("Error acknowledging album %s", media_group_id)
+
+
 @router.message(ComplaintStates.media_files, F.photo)
 async def process_photo(message: Message, state: FSMContext):
-    data = await state.get_data()
-    media_files = data.get('media_files', [])
     photo = message.photo[-1]
-
-    media_files.append({
+    item = {
         'file_id': photo.file_id,
         'file_type': 'photo'
-    })
+    }
+    if message.media_group_id:
+        buffer_album_item(message, state, item)
+        return
+
+    data = await state.get_data()
+    media_files = data.get('media_files', [])
+    media_files.append(item)
 
     await state.update_data(media_files=media_files)
 
@@ -351,13 +419,17 @@ async def process_photo(message: Message, state: FSMContext):
 
 @router.message(ComplaintStates.media_files, F.video)
 async def process_video(message: Message, state: FSMContext):
-    data = await state.get_data()
-    media_files = data.get('media_files', [])
-
-    media_files.append({
+    item = {
         'file_id': message.video.file_id,
         'file_type': 'video'
-    })
+    }
+    if message.media_group_id:
+        buffer_album_item(message, state, item)
+        return
+
+    data = await state.get_data()
+    media_files = data.get('media_files', [])
+    media_files.append(item)
 
     await state.update_data(media_files=media_files)
 
@@ -368,14 +440,18 @@ async def process_video(message: Message, state: FSMContext):
 
 @router.message(ComplaintStates.media_files, F.document)
 async def process_document(message: Message, state: FSMContext):
-    data = await state.get_data()
-    media_files = data.get('media_files', [])
-
-    media_files.append({
+    item = {
         'file_id': message.document.file_id,
         'file_type': 'document',
         'file_name': message.document.file_name
-    })
+    }
+    if message.media_group_id:
+        buffer_album_item(message, state, item)
+        return
+
+    data = await state.get_data()
+    media_files = data.get('media_files', [])
+    media_files.append(item)
 
     await state.update_data(media_files=media_files)
 
@@ -392,6 +468,12 @@ async def finish_media_upload(message: Message, state: FSMContext):
 
     data = await state.get_data()
     lang = data.get('language', 'ru')
+
+    # Album items still inside the buffering window
+    pending = pop_album_items(state.key)
+    if pending:
+        data['media_files'] = data.get('media_files', []) + pending
+        await state.update_data(media_files=data['media_files'])
     summary = await create_complaint_summary(data, lang)
 
     text = get_text(lang, 'confirmation')
@@ -464,18 +546,16 @@ async def create_complaint_summary(data: dict, lang: str) -> str:
 @router.message(ComplaintStates.confirmation, F.text.in_([
     "✅ Отправить", "✅ Yuborish"
 ]))
-async def confirm_and_send_complaint(message: Message, state: FSMContext):
+async def confirm_and_send_complaint(message: Message, state: FSMContext, db_user: TelegramUser = None):
 
     data = await state.get_data()
     lang = data.get('language', 'ru')
 
     try:
-        user = await sync_to_async(TelegramUser.objects.get)(
-            telegram_id=message.from_user.id
-        )
-
-        complaint = await sync_to_async(Complaint.objects.create)(
-            user=user,
+        media_files = data.get('media_files', [])
+        complaint = await repository.create_complaint(
+            media_files,
+            user=db_user,
             is_anonymous=data.get('is_anonymous', False),
             full_name=data.get('full_name') or (None if data.get('is_anonymous') else None),
             phone_number=data.get('phone_number') or (None if data.get('is_anonymous') else None),
@@ -493,18 +573,7 @@ async def confirm_and_send_complaint(message: Message, state: FSMContext):
             status='new'
         )
 
-        media_files = data.get('media_files', [])
-        for media in media_files:
-            await sync_to_async(ComplaintMedia.objects.create)(
-                complaint=complaint,
-                file_id=media['file_id'],
-                file_type=media['file_type'],
-                file_name=media.get('file_name')
-            )
-
-        year = datetime.now().year
-        count = await sync_to_async(lambda: Complaint.objects.filter(created_at__year=year).count())()
-        complaint_number = f"{datetime.now().year}-{datetime.now().month}-{complaint.id}"
+        complaint_number = complaint.number
 
         if GROUP_ID is not None:
             await send_complaint_to_admin(complaint, media_files, lang, complaint_number)
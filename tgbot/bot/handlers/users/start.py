@@ -2,9 +2,10 @@ from aiogram import Router, F
 from aiogram.filters import CommandStart
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
-from asgiref.sync import sync_to_async
 
+from tgbot.bot import repository
 from tgbot.models import TelegramUser
+from tgbot.bot.middlewares.user_cache import user_cache
 from tgbot.bot.keyboards.reply import language_keyboard, main_menu_keyboard
 from tgbot.bot.loader import get_text
 
@@ -12,29 +13,15 @@ router = Router()
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, db_user: TelegramUser = None):
     """Handle /start command"""
 
     # Clear any previous state
     await state.clear()
 
     # Get or create user in database
-    user, created = await sync_to_async(TelegramUser.objects.get_or_create)(
-        telegram_id=message.from_user.id,
-        defaults={
-            'username': message.from_user.username,
-            'first_name': message.from_user.first_name,
-            'last_name': message.from_user.last_name,
-            # 'language': 'ru'  # Default language
-        }
-    )
-
-    # If user exists, update info
-    if not created:
-        user.username = message.from_user.username
-        user.first_name = message.from_user.first_name
-        user.last_name = message.from_user.last_name
-        await sync_to_async(user.save)()
+    user = await repository.register_user(message.from_user, db_user)
+    user_cache.put(user)
 
     # Get user's language
     lang = user.language
@@ -59,18 +46,16 @@ async def cmd_start(message: Message, state: FSMContext):
 
 
 @router.message(F.text.in_(["Русский 🇷🇺", "O'zbekcha 🇺🇿"]))
-async def select_language(message: Message, state: FSMContext):
+async def select_language(message: Message, state: FSMContext, db_user: TelegramUser = None):
     """Handle language selection"""
 
     # Determine selected language
     lang = 'ru' if message.text == "Русский 🇷🇺" else 'uz'
 
     # Update user language in database
-    user = await sync_to_async(TelegramUser.objects.get)(
-        telegram_id=message.from_user.id
-    )
-    user.language = lang
-    await sync_to_async(user.save)()
+    user = db_user or await repository.register_user(message.from_user)
+    await repository.set_language(user, lang)
+    user_cache.put(user)
 
     # Store language in FSM context
     await state.update_data(language=lang)
@@ -87,14 +72,11 @@ async def select_language(message: Message, state: FSMContext):
 
 
 @router.message(F.text.in_(["🌐 Сменить язык", "🌐 Tilni o'zgartirish"]))
-async def change_language(message: Message, state: FSMContext):
+async def change_language(message: Message, state: FSMContext, db_user: TelegramUser = None):
     """Handle language change request"""
 
     # Get current language
-    user = await sync_to_async(TelegramUser.objects.get)(
-        telegram_id=message.from_user.id
-    )
-    lang = user.language
+    lang = db_user.language if db_user else 'ru'
 
     # Show language selection
     text = get_text(lang, 'welcome')
@@ -105,14 +87,11 @@ async def change_language(message: Message, state: FSMContext):
 
 
 @router.message(F.text.in_(["ℹ️ Информация", "ℹ️ Ma'lumot"]))
-async def show_info(message: Message):
+async def show_info(message: Message, db_user: TelegramUser = None):
     """Show bot information"""
 
     # Get user language
-    user = await sync_to_async(TelegramUser.objects.get)(
-        telegram_id=message.from_user.id
-    )
-    lang = user.language
+    lang = db_user.language if db_user else 'ru'
 
     info_text = {
         'ru': (
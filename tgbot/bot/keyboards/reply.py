@@ -172,6 +172,84 @@ def mahallas_inline_keyboard(mahallas: List[Dict], district_id: int, page: int =
         return builder.as_markup()
 
 
+class LocationKeyboardCache:
+    """Ready-made region/district/mahalla keyboards.
+
+    Location data only changes when the manager reloads, so each markup is
+    built once per key and reused until ``manager.version`` changes. A hit
+    reads no location rows; the number of mahalla pages of each district
+    is kept beside the markups to tell real pages from forged ones.
+    """
+
+    def __init__(self, manager, per_page: int = 30):
+        self.manager = manager
+        self.per_page = per_page
+        self._version = None
+        self._markups: Dict[tuple, InlineKeyboardMarkup] = {}
+        self._mahalla_pages: Dict[int, int] = {}
+
+    def _refresh(self):
+        if self._version != self.manager.version:
+            self._markups.clear()
+            self._mahalla_pages.clear()
+            self._version = self.manager.version
+
+    def _get(self, key, build):
+        self._refresh()
+        markup = self._markups.get(key)
+        if markup is None:
+            markup = self._markups[key] = build()
+        return markup
+
+    def regions(self) -> InlineKeyboardMarkup:
+        return self._get(
+            ('regions',),
+            lambda: regions_inline_keyboard(self.manager.get_all_regions())
+        )
+
+    def districts(self, region_id: int) -> InlineKeyboardMarkup:
+        def build():
+            return districts_inline_keyboard(self.manager.get_districts_by_region(region_id), region_id)
+
+        if self.manager.get_region_by_id(region_id) is None:
+            return build()
+        return self._get(('districts', region_id), build)
+
+    def mahallas(self, district_id: int, page: int = 0) -> InlineKeyboardMarkup:
+        self._refresh()
+        key = ('mahallas', district_id, page)
+        markup = self._markups.get(key)
+        if markup is not None:
+            return markup
+
+        mahallas = self.manager.get_streets_by_district(district_id)
+        markup = mahallas_inline_keyboard(mahallas, district_id, page=page, per_page=self.per_page)
+
+        # Only ids and pages that exist are cached, so forged callback data cannot grow the cache
+        pages = self._mahalla_pages.get(district_id)
+        if pages is None and self.manager.get_district_by_id(district_id) is not None:
+            pages = self._mahalla_pages[district_id] = max(1, -(-len(mahallas) // self.per_page))
+        if pages is not None and 0 <= page < pages:
+            self._markups[key] = markup
+        return markup
+
+    def warm(self):
+        """Build every region, district and first mahalla page up front."""
+        self.regions()
+        for region in self.manager.get_all_regions():
+            self.districts(region['id'])
+        for district in self.manager.districts:
+            self.mahallas(district['id'])
+
+    def clear(self):
+        self._markups.clear()
+        self._mahalla_pages.clear()
+        self._version = None
+
+    def __len__(self):
+        return len(self._markups)
+
+
 def admin_keyboard():
     builder = ReplyKeyboardBuilder()
 
@@ -1,10 +1,13 @@
 import os
-import json
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 
+from tgbot.bot.keyboards.reply import LocationKeyboardCache
+from tgbot.bot.storage import create_storage, PrunableEventIsolation
+from tgbot.bot.middlewares.fsm_cache import CachedFSMContextMiddleware
+from tgbot.bot.locations import LocationManager
+
 
 BOT_TOKEN = os.getenv('API_TOKEN')
 
@@ -40,77 +43,19 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-
-class LocationManager:
-
-    def __init__(self, json_path='data/locations.json'):
-        self.json_path = json_path
-        self.data = self._load_data()
-        self.regions = self.data.get('regions', [])
-        self.districts = self.data.get('districts', [])
-        self.streets = self.data.get('quarters', [])
-
-    def _load_data(self):
-        try:
-            with open(self.json_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"Warning: Location file {self.json_path} not found!")
-            return {'regions': [], 'districts': [], 'streets': []}
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from {self.json_path}: {e}")
-            return {'regions': [], 'districts': [], 'streets': []}
-
-    def get_all_regions(self):
-        return self.regions
-
-    def get_region_by_id(self, region_id):
-        for region in self.regions:
-            if region['id'] == region_id:
-                return region
-        return None
-
-    def get_districts_by_region(self, region_id):
-        return [d for d in self.districts if d.get('region_id') == region_id]
-
-    def get_district_by_id(self, district_id):
-        for district in self.districts:
-            if district['id'] == district_id:
-                return district
-        return None
-
-    def get_streets_by_district(self, district_id):
-        return [s for s in self.streets if s.get('district_id') == district_id]
-
-    def get_street_by_id(self, street_id):
-        for street in self.streets:
-            if street['id'] == street_id:
-                return street
-        return None
-
-    def get_full_address(self, region_id, district_id, street_id=None):
-        parts = []
-
-        region = self.get_region_by_id(region_id)
-        if region:
-            parts.append(region['name'])
-
-        district = self.get_district_by_id(district_id)
-        if district:
-            parts.append(district['name'])
-
-        if street_id:
-            street = self.get_street_by_id(street_id)
-            if street:
-                parts.append(street['name'])
+storage = create_storage()
+dp = Dispatcher(storage=storage, events_isolation=PrunableEventIsolation(), disable_fsm=True)
+# Same storage and isolation, but handlers get a context that loads once and flushes once per update
+dp.fsm = CachedFSMContextMiddleware(storage=storage, events_isolation=dp.fsm.events_isolation)
+dp.update.outer_middleware(dp.fsm)
 
-        return ', '.join(parts)
 
+LOCATIONS_WATCH_INTERVAL = float(os.getenv('LOCATIONS_WATCH_INTERVAL', '60'))
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', '300'))
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '300'))
 
 location_manager = LocationManager()
+location_keyboards = LocationKeyboardCache(location_manager)
 
 
 TEXTS = {
@@ -137,7 +82,8 @@ TEXTS = {
         'send_phone': "Отправить номер телефона 📱",
         'select_region': "🗺 Выберите регион:",
         'select_district': "🏘 Выберите район:",
-        'select_mahalla': "📍 Выберите махаллю:",
+        'select_mahalla': "📍 Выберите махаллю или напишите её название для поиска:",
+        'mahalla_not_found': "🔍 Махалля не найдена. Попробуйте другое название или выберите из списка.",
         'enter_target_name': "👨‍💼 Введите ФИО лица, на которое подается жалоба:",
         'enter_target_position': "💼 Введите должность:",
         'enter_target_org': "🏢 Введите организацию/учреждение:",
@@ -188,7 +134,8 @@ TEXTS = {
         'send_phone': "Telefon raqamini yuborish 📱",
         'select_region': "🗺 Viloyatni tanlang:",
         'select_district': "🏘 Tumanni tanlang:",
-        'select_mahalla': "📍 MFY ni tanlang:",
+        'select_mahalla': "📍 MFY ni tanlang yoki qidirish uchun nomini yozing:",
+        'mahalla_not_found': "🔍 MFY topilmadi. Boshqa nom yozing yoki ro'yxatdan tanlang.",
         'enter_target_name': "👨‍💼 Shikoyat qilinadigan shaxsning F.I.Sh.ni kiriting:",
         'enter_target_position': "💼 Lavozimni kiriting:",
         'enter_target_org': "🏢 Tashkilot/muassasani kiriting:",
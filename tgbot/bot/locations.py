@@ -0,0 +1,496 @@
+"""Location tables and the LocationManager that serves them.
+
+Two interchangeable backends expose ``regions``, ``districts`` and
+``streets`` tables with ``get(id)`` and ``children(parent_id)``:
+
+* ``JsonLocations`` - plain dicts parsed from data/locations.json.
+* ``LocationSnapshot`` - a compact binary file compiled from the JSON by
+  ``python manage.py build_locations`` and memory-mapped at load.
+
+Snapshot layout (native byte order, int32 everywhere)::
+
+    header      magic, format version, byte order, 3 table sizes,
+                3 index sizes, string count, string blob size
+    per table   ids[n], parent_ids[n], name_refs[n], rows_by_id[max id + 1]
+    strings     offsets[m + 1], utf-8 blob
+
+Rows are sorted by (parent_id, id), so the children of a parent are one
+contiguous slice found with bisect. Location ids are small and dense, so
+``rows_by_id`` maps an id straight to its row number (-1 for a gap).
+Every name is stored once in the shared string table.
+"""
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'LOCS'
+FORMAT_VERSION = 2
+_BYTEORDER = 0 if sys.byteorder == 'little' else 1
+_HEADER = struct.Struct('=4sHBx8I')
+
+# (table name, key in locations.json, parent id field)
+TABLES = (
+    ('regions', 'regions', None),
+    ('districts', 'districts', 'region_id'),
+    ('streets', 'quarters', 'district_id'),
+)
+
+
+class JsonTable(Sequence):
+    """A location table backed by the dicts from locations.json."""
+
+    def __init__(self, rows, parent_field=None):
+        self._rows = rows
+        self._by_id = {row['id']: row for row in rows}
+
+        children = {}
+        if parent_field:
+            for row in rows:
+                children.setdefault(row.get(parent_field), []).append(row)
+        self._children = {k: tuple(v) for k, v in children.items()}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        return self._rows[index]
+
+    def get(self, row_id):
+        return self._by_id.get(row_id)
+
+    def children(self, parent_id):
+        return self._children.get(parent_id, ())
+
+
+class JsonLocations:
+
+    def __init__(self, data):
+        for name, key, parent_field in TABLES:
+            setattr(self, name, JsonTable(data.get(key, []), parent_field))
+
+
+class SnapshotRows(Sequence):
+    """Rows ``start``..``end`` of a snapshot table, materialised on access."""
+
+    __slots__ = ('_table', '_start', '_length')
+
+    def __init__(self, table, start, end):
+        self._table = table
+        self._start = start
+        self._length = end - start
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self._table._row(self._start + i) for i in range(*index.indices(self._length)))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._table._row(self._start + index)
+
+
+class SnapshotTable(SnapshotRows):
+    """A location table read straight from the memory-mapped snapshot.
+
+    Rows are materialised as small dicts only when they are accessed;
+    ``children()`` returns a view over the parent's slice.
+    """
+
+    def __init__(self, snapshot, parent_field, ids, parent_ids, name_refs, rows_by_id):
+        super().__init__(self, 0, len(ids))
+        self._snapshot = snapshot
+        self._parent_field = parent_field
+        self._ids = ids
+        self._parent_ids = parent_ids
+        self._name_refs = name_refs
+        self._rows_by_id = rows_by_id
+
+    def _row(self, index):
+        row = {'id': self._ids[index]}
+        if self._parent_field:
+            row[self._parent_field] = self._parent_ids[index]
+        row['name'] = self._snapshot.string(self._name_refs[index])
+        return row
+
+    def get(self, row_id):
+        if row_id is None or row_id < 0:
+            return None
+        try:
+            index = self._rows_by_id[row_id]
+        except IndexError:
+            return None
+        return self._row(index) if index >= 0 else None
+
+    def children(self, parent_id):
+        if not self._parent_field or parent_id is None:
+            return ()
+        start = bisect_left(self._parent_ids, parent_id)
+        end = bisect_right(self._parent_ids, parent_id, lo=start)
+        return SnapshotRows(self, start, end)
+
+
+class LocationSnapshot:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self._mmap)
+        magic, version, byteorder, *sizes, string_count, blob_size = _HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT_VERSION or byteorder != _BYTEORDER:
+            raise ValueError(f"{path} is not a compatible location snapshot")
+        sizes, index_sizes = sizes[:len(TABLES)], sizes[len(TABLES):]
+
+        pos = _HEADER.size
+
+        def ints(count):
+            nonlocal pos
+            chunk = view[pos:pos + 4 * count].cast('i')
+            pos += 4 * count
+            return chunk
+
+        for (name, _, parent_field), size, index_size in zip(TABLES, sizes, index_sizes):
+            setattr(self, name, SnapshotTable(self, parent_field, ints(size), ints(size), ints(size), ints(index_size)))
+
+        self._offsets = ints(string_count + 1)
+        self._blob_start = pos
+        if len(view) - pos < blob_size:
+            raise ValueError(f"{path} is truncated")
+
+    def string(self, ref):
+        start = self._blob_start
+        return self._mmap[start + self._offsets[ref]:start + self._offsets[ref + 1]].decode('utf-8')
+
+
+def compile_snapshot(json_path, snapshot_path):
+    """Compile locations.json into a snapshot file; returns row and string counts."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    strings = {}
+    sections = []
+    counts = {}
+    for name, key, parent_field in TABLES:
+        rows = sorted(
+            data.get(key, []),
+            key=lambda row: ((row.get(parent_field) or 0) if parent_field else 0, row['id'])
+        )
+        ids = array('i', (row['id'] for row in rows))
+        parent_ids = array('i', (((row.get(parent_field) or 0) if parent_field else 0) for row in rows))
+        name_refs = array('i', (strings.setdefault(row['name'], len(strings)) for row in rows))
+        if ids and min(ids) < 0:
+            raise ValueError(f"{key} has a negative id")
+        rows_by_id = array('i', [-1]) * (max(ids) + 1 if ids else 0)
+        for index, row_id in enumerate(ids):
+            rows_by_id[row_id] = index
+        sections.append((ids, parent_ids, name_refs, rows_by_id))
+        counts[name] = len(rows)
+
+    offsets = array('i', [0])
+    blob = bytearray()
+    for value in strings:
+        blob += value.encode('utf-8')
+        offsets.append(len(blob))
+
+    # A private temporary file per compiler, so processes compiling at the
+    # same time never write into each other's file; the last replace wins
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_path) or '.', suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(
+                MAGIC, FORMAT_VERSION, _BYTEORDER,
+                *(len(section[0]) for section in sections),
+                *(len(section[3]) for section in sections),
+                len(strings), len(blob)
+            ))
+            for section in sections:
+                for column in section:
+                    column.tofile(f)
+            offsets.tofile(f)
+            f.write(blob)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    counts['strings'] = len(strings)
+    return counts
+
+
+_APOSTROPHES = dict.fromkeys(map(ord, "'`‘’ʻʼ´"), None)
+
+
+def normalize_name(text):
+    """Casefold, drop every apostrophe variant and collapse whitespace."""
+    return ' '.join(text.translate(_APOSTROPHES).casefold().split())
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class StreetSearchIndex:
+    """Prefix and trigram index over mahalla names, partitioned by district.
+
+    Queries shorter than three characters match word prefixes; longer ones
+    intersect trigram postings and confirm with a substring check.
+    """
+
+    def __init__(self, streets):
+        self._streets = streets
+        self._names = {}
+        words = {}
+        trigrams = {}
+
+        for street in streets:
+            street_id, district_id = street['id'], street['district_id']
+            name = normalize_name(street['name'])
+            self._names[street_id] = name
+            for word in set(name.split()):
+                words.setdefault(district_id, []).append((word, street_id))
+            for gram in _trigrams(name):
+                trigrams.setdefault((district_id, gram), []).append(street_id)
+
+        self._words = {k: sorted(v) for k, v in words.items()}
+        self._trigrams = {k: tuple(v) for k, v in trigrams.items()}
+
+    def search(self, district_id, query, limit=30):
+        query = normalize_name(query)
+        if not query:
+            return []
+
+        if len(query) < 3:
+            words = self._words.get(district_id, [])
+            matches = set()
+            for word, street_id in words[bisect_left(words, (query,)):]:
+                if not word.startswith(query):
+                    break
+                matches.add(street_id)
+        else:
+            postings = sorted(
+                (self._trigrams.get((district_id, gram), ()) for gram in _trigrams(query)),
+                key=len
+            )
+            matches = set(postings[0])
+            for posting in postings[1:]:
+                if not matches:
+                    break
+                matches.intersection_update(posting)
+            matches = {i for i in matches if query in self._names[i]}
+
+        def rank(street_id):
+            name = self._names[street_id]
+            if name.startswith(query):
+                return 0, name
+            if f" {query}" in f" {name}":
+                return 1, name
+            return 2, name
+
+        return [self._streets.get(i) for i in sorted(matches, key=rank)[:limit]]
+
+
+class LocationManager:
+    """Region/district/mahalla lookups.
+
+    Nothing is read until the first lookup, so processes that import the
+    loader without touching locations pay nothing. A compiled snapshot
+    (``manage.py build_locations``) is preferred while it is at least as new
+    as the JSON file; otherwise the JSON is parsed.
+
+    ``reload()`` rebuilds everything aside and swaps it in with a single
+    assignment, so a lookup always sees one complete dataset. The version
+    bump invalidates derived caches (keyboards, search index).
+
+    ``reload()`` also recompiles an outdated snapshot unless
+    ``rebuild_snapshot`` is off; readers in other processes (the admin's
+    web workers) turn it off and only reopen a snapshot once it is newer
+    than the JSON, parsing the JSON until then.
+    """
+
+    def __init__(self, json_path='data/locations.json', snapshot_path=None, rebuild_snapshot=True):
+        self.json_path = json_path
+        self.snapshot_path = snapshot_path or os.path.splitext(json_path)[0] + '.bin'
+        self.rebuild_snapshot = rebuild_snapshot
+        self._tables = None
+        self._version = 0
+        self._search_index = None
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def tables(self):
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._loaded_mtime = self._source_mtime()
+                    self._tables = self._load_tables()
+                    self._version += 1
+        return self._tables
+
+    @property
+    def version(self):
+        self.tables
+        return self._version
+
+    @property
+    def regions(self):
+        return self.tables.regions
+
+    @property
+    def districts(self):
+        return self.tables.districts
+
+    @property
+    def streets(self):
+        return self.tables.streets
+
+    def _snapshot_is_fresh(self):
+        try:
+            return os.path.getmtime(self.snapshot_path) >= os.path.getmtime(self.json_path)
+        except OSError:
+            return False
+
+    def _source_mtime(self):
+        try:
+            return os.path.getmtime(self.json_path)
+        except OSError:
+            return None
+
+    def _load_tables(self, strict=False):
+        if self._snapshot_is_fresh():
+            try:
+                return LocationSnapshot(self.snapshot_path)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring location snapshot %s: %s", self.snapshot_path, e)
+            # e.g. a snapshot written in an older format
+            if self.rebuild_snapshot:
+                try:
+                    compile_snapshot(self.json_path, self.snapshot_path)
+                    return LocationSnapshot(self.snapshot_path)
+                except (OSError, ValueError):
+                    logger.exception("Could not rebuild location snapshot %s", self.snapshot_path)
+        if strict:
+            with open(self.json_path, 'r', encoding='utf-8') as f:
+                return JsonLocations(json.load(f))
+        return JsonLocations(self._load_data())
+
+    def is_stale(self):
+        return self._tables is not None and self._source_mtime() != self._loaded_mtime
+
+    def reload(self):
+        """Rebuild the tables from disk and swap them in; returns the new version.
+
+        Raises OSError/ValueError and keeps the current data if the file
+        cannot be read.
+        """
+        mtime = self._source_mtime()
+        if self.rebuild_snapshot and os.path.exists(self.snapshot_path) and not self._snapshot_is_fresh():
+            try:
+                compile_snapshot(self.json_path, self.snapshot_path)
+            except (OSError, ValueError):
+                logger.exception("Could not rebuild location snapshot %s", self.snapshot_path)
+
+        tables = self._load_tables(strict=True)
+        search_index = None
+        if self._search_index is not None:
+            search_index = (tables, StreetSearchIndex(tables.streets))
+
+        with self._lock:
+            self._tables = tables
+            self._search_index = search_index
+            self._loaded_mtime = mtime
+            self._version += 1
+            return self._version
+
+    async def areload(self):
+        return await asyncio.to_thread(self.reload)
+
+    async def watch(self, interval):
+        """Reload whenever the JSON file's mtime changes; run as a background task."""
+        while True:
+            await asyncio.sleep(interval)
+            if not self.is_stale():
+                continue
+            try:
+                version = await self.areload()
+                logger.info("Reloaded %s (version %s)", self.json_path, version)
+            except (OSError, ValueError):
+                logger.exception("Failed to reload %s; keeping current locations", self.json_path)
+
+    def _load_data(self):
+        try:
+            with open(self.json_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logger.warning("Location file %s not found", self.json_path)
+            return {'regions': [], 'districts': [], 'quarters': []}
+        except json.JSONDecodeError:
+            logger.exception("Could not decode %s", self.json_path)
+            return {'regions': [], 'districts': [], 'quarters': []}
+
+    def get_all_regions(self):
+        return self.regions
+
+    def get_region_by_id(self, region_id):
+        return self.regions.get(region_id)
+
+    def get_districts_by_region(self, region_id):
+        return self.districts.children(region_id)
+
+    def get_district_by_id(self, district_id):
+        return self.districts.get(district_id)
+
+    def get_streets_by_district(self, district_id):
+        return self.streets.children(district_id)
+
+    def get_street_by_id(self, street_id):
+        return self.streets.get(street_id)
+
+    def get_street_search_index(self):
+        tables = self.tables
+        search_index = self._search_index
+        if search_index is None or search_index[0] is not tables:
+            search_index = self._search_index = (tables, StreetSearchIndex(tables.streets))
+        return search_index[1]
+
+    def search_streets(self, district_id, query, limit=30):
+        """Mahallas of a district whose name contains ``query``, best matches first."""
+        return self.get_street_search_index().search(district_id, query, limit)
+
+    def get_full_address(self, region_id, district_id, street_id=None):
+        parts = []
+
+        region = self.get_region_by_id(region_id)
+        if region:
+            parts.append(region['name'])
+
+        district = self.get_district_by_id(district_id)
+        if district:
+            parts.append(district['name'])
+
+        if street_id:
+            street = self.get_street_by_id(street_id)
+            if street:
+                parts.append(street['name'])
+
+        return ', '.join(parts)
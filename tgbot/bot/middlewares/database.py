@@ -0,0 +1,28 @@
+# tgbot/bot/middlewares/database.py
+
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from tgbot.bot import repository
+
+
+class DatabaseConnectionMiddleware(BaseMiddleware):
+    """Release the async ORM's connection once an update is handled.
+
+    The bot's equivalent of Django's request_finished: with pooling the
+    connection goes back to the pool, otherwise it is closed only if it is
+    broken or older than CONN_MAX_AGE.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            await repository.release_connection()
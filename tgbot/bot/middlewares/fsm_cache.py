@@ -0,0 +1,136 @@
+# tgbot/bot/middlewares/fsm_cache.py
+
+import copy
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, StateType, StorageKey
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class CachedFSMContext(FSMContext):
+    """FSMContext that reads state and data once and writes them back once.
+
+    Reads are served from memory after the first load; writes only mark the
+    state/data dirty until ``flush()``. With PipelinedRedisStorage both the
+    load and the flush are a single round trip.
+    """
+
+    def __init__(self, storage, key: StorageKey) -> None:
+        super().__init__(storage=storage, key=key)
+        self._loaded = False
+        self._state: Optional[str] = None
+        self._data: Dict[str, Any] = {}
+        self._state_dirty = False
+        self._data_dirty = False
+        self.storage_calls = 0
+
+    async def _load(self) -> None:
+        if self._loaded:
+            return
+        if hasattr(self.storage, 'get_state_and_data'):
+            self._state, self._data = await self.storage.get_state_and_data(self.key)
+            self.storage_calls += 1
+        else:
+            self._state = await self.storage.get_state(self.key)
+            self._data = await self.storage.get_data(self.key)
+            self.storage_calls += 2
+        self._loaded = True
+
+    async def get_state(self) -> Optional[str]:
+        await self._load()
+        return self._state
+
+    async def set_state(self, state: StateType = None) -> None:
+        await self._load()
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        await self._load()
+        return copy.deepcopy(self._data)
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        await self._load()
+        self._data = copy.deepcopy(data)
+        self._data_dirty = True
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        await self._load()
+        return copy.deepcopy(self._data.get(key, default))
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        await self._load()
+        self._data.update(copy.deepcopy(kwargs))
+        self._data_dirty = True
+        return copy.deepcopy(self._data)
+
+    async def flush(self) -> None:
+        if self._state_dirty and self._data_dirty and hasattr(self.storage, 'set_state_and_data'):
+            await self.storage.set_state_and_data(self.key, self._state, self._data)
+            self.storage_calls += 1
+        else:
+            if self._state_dirty:
+                await self.storage.set_state(self.key, self._state)
+                self.storage_calls += 1
+            if self._data_dirty:
+                await self.storage.set_data(self.key, self._data)
+                self.storage_calls += 1
+        self._state_dirty = self._data_dirty = False
+
+
+class CachedFSMContextMiddleware(FSMContextMiddleware):
+    """Drop-in FSM middleware that hands handlers a CachedFSMContext.
+
+    Pending changes are flushed once the handler returns (or raises, so
+    partial progress is kept the same way direct writes used to be).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        bot: Bot = data["bot"]
+        context = self.resolve_event_context(bot, data)
+        data["fsm_storage"] = self.storage
+        if not context:
+            return await handler(event, data)
+
+        async with self.events_isolation.lock(key=context.key):
+            data.update({"state": context, "raw_state": await context.get_state()})
+            try:
+                return await handler(event, data)
+            finally:
+                await context.flush()
+                logger.debug("FSM %s: %d storage calls", context.key.user_id, context.storage_calls)
+
+    def get_context(
+        self,
+        bot: Bot,
+        chat_id: int,
+        user_id: int,
+        thread_id: Optional[int] = None,
+        business_connection_id: Optional[str] = None,
+        destiny: str = DEFAULT_DESTINY,
+    ) -> CachedFSMContext:
+        return CachedFSMContext(
+            storage=self.storage,
+            key=StorageKey(
+                user_id=user_id,
+                chat_id=chat_id,
+                bot_id=bot.id,
+                thread_id=thread_id,
+                business_connection_id=business_connection_id,
+                destiny=destiny,
+            ),
+        )
@@ -1,27 +1,181 @@
 # tgbot/bot/middlewares/throttling.py
 
+from collections import OrderedDict
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, TelegramObject
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
+
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, time_limit: float = 0.5):
-        self.time_limit = time_limit
-        self.user_timestamps: Dict[int, float] = {}
+    """Per-user token bucket with a bounded table.
+
+    Each user may send ``burst`` events at once and then ``rate`` events
+    per second. The bucket is kept in GCRA form - a single "theoretical
+    arrival time" per user - on the monotonic clock. Users live in an LRU
+    table capped at ``max_users``; a user whose bucket has refilled is the
+    same as an unknown user, so ``prune()`` drops them.
+
+    Register one instance per event type to give each its own budget.
+    Items of an album after the first share the first item's token. A
+    throttled callback query is still answered, with a short notice.
+    """
+
+    def __init__(self, rate: float = 2.0, burst: int = 3, max_users: int = 100_000, max_albums: int = 1_000):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.max_users = max_users
+        self.max_albums = max_albums
+        self.arrivals: "OrderedDict[int, float]" = OrderedDict()
+        self.albums: "OrderedDict[str, None]" = OrderedDict()
+        self.throttled = 0
+
+    def allow(self, user_id: int, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+
+        arrival = max(self.arrivals.get(user_id, now), now)
+        if arrival - now > self.tolerance:
+            self.throttled += 1
+            return False
+
+        self.arrivals[user_id] = arrival + self.interval
+        self.arrivals.move_to_end(user_id)
+        if len(self.arrivals) > self.max_users:
+            self.arrivals.popitem(last=False)
+        return True
+
+    async def check(self, user_id: int) -> bool:
+        return self.allow(user_id)
+
+    def prune(self) -> int:
+        """Forget users whose bucket is full again."""
+        now = time.monotonic()
+        idle = [user_id for user_id, arrival in self.arrivals.items() if arrival <= now]
+        for user_id in idle:
+            del self.arrivals[user_id]
+        return len(idle)
 
     async def __call__(
         self,
-        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-        event: Message,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        user_id = event.from_user.id
-        current_time = time.time()
-        last_time = self.user_timestamps.get(user_id)
+        user = getattr(event, 'from_user', None)
+        if user is None:
+            return await handler(event, data)
+
+        media_group_id = getattr(event, 'media_group_id', None)
+        if media_group_id and media_group_id in self.albums:
+            return await handler(event, data)
 
-        if last_time and (current_time - last_time) < self.time_limit:
+        if not await self.check(user.id):
+            if isinstance(event, CallbackQuery):
+                # Otherwise the button keeps spinning until Telegram gives up
+                try:
+                    await event.answer("⏳ Juda tez, biroz kuting")
+                except Exception:
+                    logger.debug("Could not answer a throttled callback", exc_info=True)
             return
-        self.user_timestamps[user_id] = current_time
+
+        if media_group_id:
+            self.albums[media_group_id] = None
+            if len(self.albums) > self.max_albums:
+                self.albums.popitem(last=False)
 
         return await handler(event, data)
+
+
+# GCRA bucket shared by every worker. Grants up to ARGV[3] tokens at once,
+# but more than one only while the bucket would still keep a spare token.
+# Returns the number of tokens granted (0 = throttled).
+_TAKE_TOKENS = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+
+local available = burst - math.ceil((tat - now) / interval)
+if available < 1 then
+    return 0
+end
+
+local granted = 1
+if available > wanted then
+    granted = wanted
+end
+
+tat = tat + granted * interval
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil(tat - now))
+return granted
+"""
+
+
+class RedisThrottlingMiddleware(ThrottlingMiddleware):
+    """Token bucket shared across bot processes through Redis.
+
+    The check-and-take is one Lua script call, so it is atomic and costs a
+    single round trip. Users clearly under budget get a small lease of
+    tokens which this process spends locally without asking Redis again;
+    leases are already charged in Redis, so unused ones only make the limit
+    stricter, never looser. If Redis is unreachable the local bucket is used.
+    """
+
+    def __init__(self, redis, name: str, rate: float = 2.0, burst: int = 3, lease: int = 2,
+                 lease_ttl: float = None, max_users: int = 100_000, **kwargs):
+        super().__init__(rate=rate, burst=burst, max_users=max_users, **kwargs)
+        self.redis = redis
+        self.prefix = f"throttle:{name}:"
+        self.burst = burst
+        self.lease = lease
+        self.lease_ttl = self.interval if lease_ttl is None else lease_ttl
+        self.leases: "OrderedDict[int, list]" = OrderedDict()
+        self.script = redis.register_script(_TAKE_TOKENS)
+        self.redis_calls = 0
+
+    async def check(self, user_id: int) -> bool:
+        now = time.monotonic()
+        lease = self.leases.get(user_id)
+        if lease is not None and lease[0] > 0 and lease[1] > now:
+            lease[0] -= 1
+            return True
+
+        try:
+            self.redis_calls += 1
+            granted = int(await self.script(
+                keys=[f"{self.prefix}{user_id}"],
+                args=[self.interval * 1000, self.burst, self.lease]
+            ))
+        except Exception:
+            logger.warning("Redis throttling unavailable; using the local bucket", exc_info=True)
+            return self.allow(user_id, now)
+
+        if granted < 1:
+            self.throttled += 1
+            return False
+
+        if granted > 1:
+            self.leases[user_id] = [granted - 1, now + self.lease_ttl]
+            self.leases.move_to_end(user_id)
+            if len(self.leases) > self.max_users:
+                self.leases.popitem(last=False)
+        else:
+            self.leases.pop(user_id, None)
+        return True
+
+    def prune(self) -> int:
+        now = time.monotonic()
+        expired = [user_id for user_id, (_, expires_at) in self.leases.items() if expires_at <= now]
+        for user_id in expired:
+            del self.leases[user_id]
+        return super().prune() + len(expired)
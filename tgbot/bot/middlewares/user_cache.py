@@ -0,0 +1,88 @@
+# tgbot/bot/middlewares/user_cache.py
+
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Awaitable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from tgbot.bot import repository
+from tgbot.models import TelegramUser
+
+
+class TelegramUserCache:
+    """LRU + TTL cache of TelegramUser rows keyed by telegram_id."""
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users: "OrderedDict[int, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int) -> Optional[TelegramUser]:
+        entry = self._users.get(telegram_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self._users.pop(telegram_id, None)
+            self.misses += 1
+            return None
+        self._users.move_to_end(telegram_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: TelegramUser) -> None:
+        self._users[user.telegram_id] = (time.monotonic() + self.ttl, user)
+        self._users.move_to_end(user.telegram_id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, telegram_id: int) -> None:
+        self._users.pop(telegram_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'users': len(self._users),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def prune(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._users.items() if expires_at <= now]
+        for key in expired:
+            del self._users[key]
+        return len(expired)
+
+
+user_cache = TelegramUserCache()
+
+
+class TelegramUserMiddleware(BaseMiddleware):
+    """Resolve the sender's TelegramUser once per update and pass it as ``db_user``.
+
+    ``db_user`` is None for senders who never pressed /start.
+    """
+
+    def __init__(self, cache: TelegramUserCache = user_cache):
+        self.cache = cache
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        data['db_user'] = None
+        from_user = data.get('event_from_user')
+        if from_user is not None:
+            user = self.cache.get(from_user.id)
+            if user is None:
+                user = await repository.get_user(from_user.id)
+                if user is not None:
+                    self.cache.put(user)
+            data['db_user'] = user
+
+        return await handler(event, data)
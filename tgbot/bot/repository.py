@@ -0,0 +1,311 @@
+"""Database access for the bot handlers.
+
+Single-statement lookups and writes go through Django's async ORM
+(``afirst``, ``aupdate``, ``acreate`` ...). Work that spans several
+statements or walks many rows is handed to ``run_sync``, which runs it on
+a small dedicated thread pool instead of the one thread the async ORM
+shares, so a slow export cannot hold up every other user's queries.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q, Sum
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from tgbot.models import (
+    TelegramUser, Complaint, ComplaintCounter, ComplaintDailyStats, ComplaintMedia, BroadcastMessage
+)
+
+
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', '30'))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='bot-db')
+_checkouts = 0
+
+
+def _count_checkout(sender, **kwargs):
+    global _checkouts
+    _checkouts += 1
+
+
+connection_created.connect(_count_checkout)
+
+
+def _call(func, args, kwargs):
+    # Each job is treated like a request: the connection is checked before
+    # use and released afterwards - back to the pool, or kept open until
+    # CONN_MAX_AGE when pooling is off.
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run blocking ORM work on the bounded database pool."""
+    return await sync_to_async(_call, thread_sensitive=False, executor=_executor)(func, args, kwargs)
+
+
+release_connection = sync_to_async(close_old_connections)
+
+
+def connection_stats():
+    """Connection checkouts, plus psycopg_pool's counters when pooling is on.
+
+    ``requests_num`` / ``requests_wait_ms`` are pool checkouts and the time
+    spent waiting for them, ``connections_num`` / ``connections_ms`` the
+    physical connections opened and the time it took.
+    """
+    stats = {'checkouts': _checkouts}
+    pool = getattr(connection, 'pool', None)
+    if pool is not None:
+        stats.update(pool.get_stats())
+    return stats
+
+
+# Users
+
+async def get_user(telegram_id):
+    return await TelegramUser.objects.filter(telegram_id=telegram_id).afirst()
+
+
+PROFILE_FIELDS = ('username', 'first_name', 'last_name')
+
+
+def upsert_user(telegram_id, profile):
+    """Insert a TelegramUser or refresh its profile in one statement.
+
+    The ON CONFLICT branch only fires when a profile field differs, so an
+    unchanged user costs no write; that case returns no row and the user
+    is read back instead.
+    """
+    now = timezone.now()
+    values = {
+        'telegram_id': telegram_id,
+        **profile,
+        'language': TelegramUser._meta.get_field('language').get_default(),
+        'is_blocked': False,
+        'created_at': now,
+        'updated_at': now,
+    }
+    fields = [TelegramUser._meta.get_field(name) for name in values]
+    params = [field.get_db_prep_save(values[field.name], connection) for field in fields]
+
+    qn = connection.ops.quote_name
+    table = qn(TelegramUser._meta.db_table)
+    updated = [qn(name) for name in (*profile, 'updated_at')]
+    returning = ', '.join(qn(field.column) for field in TelegramUser._meta.concrete_fields)
+    sql = (
+        f"INSERT INTO {table} ({', '.join(qn(field.column) for field in fields)}) "
+        f"VALUES ({', '.join(['%s'] * len(fields))}) "
+        f"ON CONFLICT ({qn('telegram_id')}) DO UPDATE SET "
+        + ', '.join(f"{column} = EXCLUDED.{column}" for column in updated)
+        + " WHERE "
+        + ' OR '.join(f"{table}.{qn(name)} IS DISTINCT FROM EXCLUDED.{qn(name)}" for name in profile)
+        + f" RETURNING {returning}"
+    )
+
+    rows = list(TelegramUser.objects.raw(sql, params))
+    return rows[0] if rows else TelegramUser.objects.get(telegram_id=telegram_id)
+
+
+async def register_user(from_user, user=None):
+    """Create the TelegramUser for a /start or refresh its profile fields.
+
+    ``user`` is the row already loaded for this sender, if any; when its
+    profile matches nothing is written, otherwise only the changed columns
+    are updated.
+    """
+    profile = {field: getattr(from_user, field) for field in PROFILE_FIELDS}
+    if user is None:
+        return await run_sync(upsert_user, from_user.id, profile)
+
+    changed = {field: value for field, value in profile.items() if getattr(user, field) != value}
+    if changed:
+        changed['updated_at'] = timezone.now()
+        await TelegramUser.objects.filter(pk=user.pk).aupdate(**changed)
+        for field, value in changed.items():
+            setattr(user, field, value)
+    return user
+
+
+async def set_language(user, language):
+    user.language = language
+    await user.asave(update_fields=['language', 'updated_at'])
+
+
+# Complaints
+
+def next_complaint_number(today=None):
+    """Take the next number of the current month, e.g. ``2025-3-17``.
+
+    One upsert on the month's counter row; the row stays locked until the
+    surrounding transaction ends, so numbers are unique and a rolled back
+    complaint gives its number back.
+    """
+    today = today or timezone.localdate()
+    table = connection.ops.quote_name(ComplaintCounter._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (year, month, value) VALUES (%s, %s, 1) "
+            f"ON CONFLICT (year, month) DO UPDATE SET value = {table}.value + 1 "
+            f"RETURNING value",
+            [today.year, today.month]
+        )
+        value = cursor.fetchone()[0]
+    return f"{today.year}-{today.month}-{value}"
+
+
+def save_complaint(media_files=(), **fields):
+    """Number a complaint and insert it with all of its media in one transaction."""
+    with transaction.atomic():
+        complaint = Complaint.objects.create(number=next_complaint_number(), **fields)
+        ComplaintMedia.objects.bulk_create([
+            ComplaintMedia(
+                complaint=complaint,
+                file_id=media['file_id'],
+                file_type=media['file_type'],
+                file_name=media.get('file_name')
+            )
+            for media in media_files
+        ])
+    return complaint
+
+
+async def create_complaint(media_files=(), **fields):
+    return await run_sync(save_complaint, media_files, **fields)
+
+
+def complaint_statistics(today=None):
+    """Status, period and anonymity counts in one aggregate over the daily rollup.
+
+    Periods are calendar days in TIME_ZONE: today, the last 7 days and the
+    last 30 days, today included.
+    """
+    today = today or timezone.localdate()
+    stats = ComplaintDailyStats.objects.aggregate(
+        total=Sum('count', default=0),
+        new=Sum('count', filter=Q(status='new'), default=0),
+        in_progress=Sum('count', filter=Q(status='in_progress'), default=0),
+        resolved=Sum('count', filter=Q(status='resolved'), default=0),
+        rejected=Sum('count', filter=Q(status='rejected'), default=0),
+        today=Sum('count', filter=Q(date=today), default=0),
+        week=Sum('count', filter=Q(date__gt=today - timedelta(days=7)), default=0),
+        month=Sum('count', filter=Q(date__gt=today - timedelta(days=30)), default=0),
+        anonymous=Sum('count', filter=Q(is_anonymous=True), default=0),
+    )
+    stats['users'] = TelegramUser.objects.count()
+    return stats
+
+
+class StatisticsCache:
+    """complaint_statistics() cached in Django's cache for ``ttl`` seconds.
+
+    Entries are keyed by ComplaintDailyStats' generation number, so any
+    complaint change retires them at once; a result computed across a
+    change is stored under the old generation and never read. Concurrent
+    misses in this process share one computation.
+    """
+
+    def __init__(self, ttl: int = STATS_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._pending = {}
+
+    async def get(self):
+        generation = await cache.aget(ComplaintDailyStats.CACHE_GENERATION_KEY, 0)
+        key = f"tgbot:complaint_stats:{generation}"
+        stats = await cache.aget(key)
+        if stats is not None:
+            self.hits += 1
+            return stats
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._pending[key] = asyncio.ensure_future(self._compute(key))
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    async def _compute(self, key):
+        stats = await run_sync(complaint_statistics)
+        await cache.aset(key, stats, self.ttl)
+        return stats
+
+    def stats(self):
+        served = self.hits + self.misses + self.shared
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'hit_ratio': round((self.hits + self.shared) / served, 3) if served else None,
+        }
+
+
+statistics_cache = StatisticsCache()
+
+
+def complaint_rows(fields, chunk_size):
+    """Stream complaints newest first as ``values_list`` tuples (server-side cursor on Postgres)."""
+    return (
+        Complaint.objects.order_by('-created_at', '-id')
+        .values_list(*fields)
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def count_complaints():
+    """Total number of complaints, read from the daily rollup."""
+    return ComplaintDailyStats.objects.aggregate(total=Sum('count', default=0))['total']
+
+
+# Broadcasts
+
+def create_broadcast(**fields):
+    """Record a new broadcast together with the number of users it will reach."""
+    total = TelegramUser.objects.filter(is_blocked=False).count()
+    return BroadcastMessage.objects.create(total_count=total, **fields)
+
+
+def broadcast_recipients(after_id, limit):
+    """The next ``limit`` active users after ``after_id`` as ``(id, telegram_id)`` pairs."""
+    return list(
+        TelegramUser.objects.filter(is_blocked=False, pk__gt=after_id)
+        .order_by('pk')
+        .values_list('pk', 'telegram_id')[:limit]
+    )
+
+
+def checkpoint_broadcast(broadcast_id, last_user_id, sent_count, failed_count, blocked_ids=(), completed=False):
+    """Save a broadcast's progress and mark the users who blocked the bot.
+
+    A checkpoint older than the stored one is ignored, so saves that land
+    out of order never move a broadcast backwards.
+    """
+    now = timezone.now()
+    fields = dict(last_user_id=last_user_id, sent_count=sent_count, failed_count=failed_count)
+    if completed:
+        fields['completed_at'] = now
+    with transaction.atomic():
+        if blocked_ids:
+            TelegramUser.objects.filter(pk__in=blocked_ids).update(is_blocked=True, updated_at=now)
+        BroadcastMessage.objects.filter(pk=broadcast_id, last_user_id__lte=last_user_id).update(**fields)
+
+
+async def unfinished_broadcasts():
+    return [
+        broadcast async for broadcast in
+        BroadcastMessage.objects.filter(completed_at__isnull=True, chat_id__isnull=False).order_by('pk')
+    ]
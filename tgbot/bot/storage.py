@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+
+try:
+    from aiogram.fsm.storage.redis import RedisStorage
+except ImportError:  # redis is only needed when FSM_STORAGE=redis
+    RedisStorage = None
+
+logger = logging.getLogger(__name__)
+
+
+if RedisStorage is not None:
+
+    class PipelinedRedisStorage(RedisStorage):
+        """RedisStorage with combined state+data operations.
+
+        ``get_state_and_data`` reads both records with one MGET and
+        ``set_state_and_data`` writes both (with their TTLs) in one pipeline,
+        so a step that touches both costs one round trip instead of two.
+        """
+
+        def _keys(self, key: StorageKey) -> Tuple[str, str]:
+            return self.key_builder.build(key, "state"), self.key_builder.build(key, "data")
+
+        async def get_state_and_data(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+            state, data = await self.redis.mget(self._keys(key))
+            if isinstance(state, bytes):
+                state = state.decode("utf-8")
+            if data is None:
+                return state, {}
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            return state, self.json_loads(data)
+
+        async def set_state_and_data(self, key: StorageKey, state: StateType, data: Dict[str, Any]) -> None:
+            state_key, data_key = self._keys(key)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                if state is None:
+                    pipe.delete(state_key)
+                else:
+                    pipe.set(state_key, state.state if isinstance(state, State) else state, ex=self.state_ttl)
+                if not data:
+                    pipe.delete(data_key)
+                else:
+                    pipe.set(data_key, self.json_dumps(data), ex=self.data_ttl)
+                await pipe.execute()
+
+
+class DraftMemoryStorage(MemoryStorage):
+    """MemoryStorage that forgets abandoned drafts.
+
+    Every access stamps the key with a last-touched time. ``sweep()`` drops
+    drafts idle for longer than ``ttl``; once more than ``max_drafts`` are
+    held, the least recently touched one is evicted on the next write.
+    Keys with no state and no data are never kept, so users who merely
+    talk to the bot do not accumulate empty records.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_drafts: Optional[int] = None) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.max_drafts = max_drafts
+        self._touched: "OrderedDict[StorageKey, float]" = OrderedDict()
+        self.evicted_expired = 0
+        self.evicted_overflow = 0
+        self.bytes_reclaimed = 0
+
+    def _touch(self, key: StorageKey) -> None:
+        record = self.storage.get(key)
+        if record is None or (record.state is None and not record.data):
+            self.storage.pop(key, None)
+            self._touched.pop(key, None)
+            return
+
+        self._touched[key] = time.monotonic()
+        self._touched.move_to_end(key)
+        while self.max_drafts and len(self._touched) > self.max_drafts:
+            self._evict(next(iter(self._touched)))
+            self.evicted_overflow += 1
+
+    def _evict(self, key: StorageKey) -> None:
+        self._touched.pop(key, None)
+        record = self.storage.pop(key, None)
+        if record is not None:
+            # Serialised size is a cheap, stable proxy for what the draft held
+            self.bytes_reclaimed += len(json.dumps(record.data, ensure_ascii=False, default=str).encode('utf-8'))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        value = await super().get_state(key)
+        self._touch(key)
+        return value
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await super().get_data(key)
+        self._touch(key)
+        return value
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        value = await super().get_value(storage_key, dict_key, default)
+        self._touch(storage_key)
+        return value
+
+    def sweep(self) -> int:
+        """Evict drafts idle for longer than ``ttl``; returns how many were dropped."""
+        if not self.ttl:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        evicted = 0
+        # _touched is kept in last-touched order, so expired keys are at the front
+        while self._touched:
+            key, touched_at = next(iter(self._touched.items()))
+            if touched_at > deadline:
+                break
+            self._evict(key)
+            evicted += 1
+        self.evicted_expired += evicted
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'drafts': len(self._touched),
+            'evicted_expired': self.evicted_expired,
+            'evicted_overflow': self.evicted_overflow,
+            'bytes_reclaimed': self.bytes_reclaimed,
+        }
+
+
+class PrunableEventIsolation(SimpleEventIsolation):
+    """SimpleEventIsolation whose per-key locks are dropped once idle.
+
+    Every update inside ``lock()`` - holding the lock or queued for it - is
+    counted, and a key's lock is dropped when its count reaches zero. An
+    unlocked lock is not enough: between ``release()`` and the next waiter
+    waking up it is unlocked while still owed to that waiter.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._holders: Dict[Any, int] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with self._locks[key]:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                self._locks.pop(key, None)
+
+    def prune(self) -> int:
+        """Drop locks nobody holds or waits for."""
+        idle = [key for key in self._locks if key not in self._holders]
+        for key in idle:
+            del self._locks[key]
+        return len(idle)
+
+
+def _ttl(name: str, default: int) -> Optional[int]:
+    value = int(os.getenv(name, default))
+    return value if value > 0 else None
+
+
+def redis_url() -> Optional[str]:
+    url = os.getenv('REDIS_URL')
+    if url:
+        return url
+    host = os.getenv('REDIS_HOST')
+    if host:
+        return f"redis://{host}:{os.getenv('REDIS_PORT', '6379')}/{os.getenv('REDIS_DB', '0')}"
+    return None
+
+
+def create_storage() -> BaseStorage:
+    """Pick the FSM storage from the environment.
+
+    FSM_STORAGE=redis|memory; by default Redis is used when REDIS_URL or
+    REDIS_HOST is set. FSM_STATE_TTL / FSM_DATA_TTL are in seconds
+    (0 disables expiry); in memory FSM_DATA_TTL is the idle time after which
+    a draft is swept and FSM_MAX_DRAFTS caps how many are held.
+    """
+    url = redis_url()
+    backend = os.getenv('FSM_STORAGE') or ('redis' if url else 'memory')
+
+    if backend == 'redis':
+        if RedisStorage is None:
+            logger.warning("FSM_STORAGE=redis but the redis package is missing; using MemoryStorage")
+        elif not url:
+            logger.warning("FSM_STORAGE=redis but REDIS_URL/REDIS_HOST is not set; using MemoryStorage")
+        else:
+            return PipelinedRedisStorage.from_url(
+                url,
+                state_ttl=_ttl('FSM_STATE_TTL', 7 * 24 * 3600),
+                data_ttl=_ttl('FSM_DATA_TTL', 7 * 24 * 3600),
+            )
+
+    return DraftMemoryStorage(
+        ttl=_ttl('FSM_DATA_TTL', 7 * 24 * 3600),
+        max_drafts=int(os.getenv('FSM_MAX_DRAFTS', '50000')) or None,
+    )
+
+
+async def sweep_forever(storage: BaseStorage, isolation, interval: float, extra=()) -> None:
+    """Periodically evict idle drafts, idle locks and anything in ``extra`` with a ``prune()``."""
+    while True:
+        await asyncio.sleep(interval)
+        if isinstance(storage, DraftMemoryStorage):
+            evicted = storage.sweep()
+            if evicted:
+                logger.info("Swept %d idle FSM drafts: %s", evicted, storage.stats())
+        if isinstance(isolation, PrunableEventIsolation):
+            isolation.prune()
+        for target in extra:
+            target.prune()
@@ -0,0 +1,223 @@
+"""Changelist pieces that keep the complaint admin fast on a large table.
+
+* ``EstimatedCountPaginator`` counts exactly only up to
+  ADMIN_COUNT_THRESHOLD rows; beyond that it reports Postgres' estimate
+  (``pg_class.reltuples`` for the whole table, the planner's row estimate
+  for a filtered list).
+* ``ComplaintChangeList`` pages the default newest-first ordering with a
+  keyset on ``(created_at, id)`` - ``?after=`` / ``?before=`` hold the
+  last / first row of the neighbouring page - so every page costs the
+  same as the first. Other orderings (search rank, a clicked column)
+  keep numbered pages.
+* ``RegionFilter`` / ``DistrictFilter`` list choices from the location
+  dataset and filter on the indexed id columns, instead of a DISTINCT
+  over the names of every complaint.
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+from tgbot.bot.locations import LocationManager
+
+ADMIN_COUNT_THRESHOLD = int(os.getenv('ADMIN_COUNT_THRESHOLD', '10000'))
+
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+KEYSET_ORDERING = ('-created_at', '-pk')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator whose count stops being exact past ``threshold`` rows."""
+
+    threshold = ADMIN_COUNT_THRESHOLD
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        postgres = connection.vendor == 'postgresql'
+
+        if postgres and not queryset.query.where:
+            estimate = self._table_estimate(connection, queryset.model._meta.db_table)
+            if estimate > self.threshold:
+                self.estimated = True
+                return estimate
+
+        # Only the pk is selected, so annotations (media count, search
+        # headline) are not computed for every counted row
+        count = queryset.order_by().values('pk')[:self.threshold + 1].count()
+        if count > self.threshold:
+            self.estimated = True
+            if postgres:
+                count = max(count, self._plan_estimate(queryset))
+        return count
+
+    @staticmethod
+    def _table_estimate(connection, table):
+        # -1 until the table has been vacuumed or analyzed
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+            row = cursor.fetchone()
+        return row[0] if row else -1
+
+    @staticmethod
+    def _plan_estimate(queryset):
+        plan = json.loads(queryset.order_by().values('pk').explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+def encode_cursor(created_at, pk):
+    micros = (created_at - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{pk}"
+
+
+def decode_cursor(value):
+    try:
+        micros, pk = value.split('_')
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        raise IncorrectLookupParameters(f"Invalid page cursor: {value!r}")
+
+
+class ComplaintChangeList(ChangeList):
+
+    def __init__(self, request, *args, **kwargs):
+        self.after = request.GET.get(AFTER_VAR)
+        self.before = request.GET.get(BEFORE_VAR)
+        self.keyset_pagination = False
+        super().__init__(request, *args, **kwargs)
+        # Filter and sort links start again from the newest complaints
+        self.params.pop(AFTER_VAR, None)
+        self.params.pop(BEFORE_VAR, None)
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(AFTER_VAR, None)
+        params.pop(BEFORE_VAR, None)
+        return params
+
+    def get_ordering(self, request, queryset):
+        # Search results come best match first unless a column was clicked
+        if ORDER_VAR not in self.params and 'search_rank' in queryset.query.annotations:
+            return ['-search_rank', '-created_at', '-pk']
+        return super().get_ordering(request, queryset)
+
+    def get_results(self, request):
+        if self.show_all or tuple(self.queryset.query.order_by) != KEYSET_ORDERING:
+            return super().get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        per_page = self.list_per_page
+        queryset = self.queryset
+
+        if self.before:
+            created_at, pk = decode_cursor(self.before)
+            rows = list(
+                queryset
+                .filter(Q(created_at__gt=created_at) | Q(pk__gt=pk), created_at__gte=created_at)
+                .order_by('created_at', 'pk')[:per_page + 1]
+            )
+            has_newer = len(rows) > per_page
+            rows = rows[:per_page][::-1]
+            has_older = True
+        else:
+            if self.after:
+                created_at, pk = decode_cursor(self.after)
+                # The lte bound lets the created_at index start at the cursor
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(pk__lt=pk), created_at__lte=created_at)
+            rows = list(queryset[:per_page + 1])
+            has_older = len(rows) > per_page
+            rows = rows[:per_page]
+            has_newer = bool(self.after)
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_newer or has_older
+        self.paginator = paginator
+        self.keyset_pagination = True
+        self.newest_url = self.newer_url = self.older_url = None
+        if has_newer and rows:
+            self.newest_url = self.get_query_string(remove=[AFTER_VAR, BEFORE_VAR])
+            self.newer_url = self.get_query_string({BEFORE_VAR: encode_cursor(rows[0].created_at, rows[0].pk)}, [AFTER_VAR])
+        if has_older and rows:
+            self.older_url = self.get_query_string({AFTER_VAR: encode_cursor(rows[-1].created_at, rows[-1].pk)}, [BEFORE_VAR])
+
+
+# The bot's watcher recompiles the snapshot; web workers only read it
+locations = LocationManager(rebuild_snapshot=False)
+
+
+def _locations():
+    if locations.is_stale():
+        locations.reload()
+    return locations
+
+
+def _location_id(value):
+    if not value.isdigit():
+        raise IncorrectLookupParameters(f"Invalid location id: {value!r}")
+    return int(value)
+
+
+class RegionFilter(admin.SimpleListFilter):
+    title = _('Region')
+    parameter_name = 'region'
+
+    def lookups(self, request, model_admin):
+        return [(region['id'], region['name']) for region in _locations().regions]
+
+    def choices(self, changelist):
+        # Picking another region drops the district of the previous one
+        yield {
+            'selected': self.value() is None,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name, DistrictFilter.parameter_name]),
+            'display': _('All'),
+        }
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.value() == str(lookup),
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: lookup}, [DistrictFilter.parameter_name]
+                ),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(region_id=_location_id(self.value()))
+
+
+class DistrictFilter(admin.SimpleListFilter):
+    """Districts of the selected region; hidden until a region is picked."""
+
+    title = _('District')
+    parameter_name = 'district'
+
+    def lookups(self, request, model_admin):
+        region_id = request.GET.get(RegionFilter.parameter_name)
+        if not region_id or not region_id.isdigit():
+            return []
+        return [(district['id'], district['name']) for district in _locations().get_districts_by_region(int(region_id))]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(district_id=_location_id(self.value()))
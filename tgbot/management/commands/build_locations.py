@@ -0,0 +1,25 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from tgbot.bot.locations import compile_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Compile data/locations.json into the memory-mapped location snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='data/locations.json')
+        parser.add_argument('--output', default=None)
+
+    def handle(self, *args, **options):
+        source = options['source']
+        output = options['output'] or os.path.splitext(source)[0] + '.bin'
+
+        counts = compile_snapshot(source, output)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {output} ({os.path.getsize(output)} bytes): "
+            f"{counts['regions']} regions, {counts['districts']} districts, "
+            f"{counts['streets']} mahallas, {counts['strings']} strings"
+        ))
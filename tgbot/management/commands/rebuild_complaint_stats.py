@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from tgbot.models import ComplaintDailyStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the ComplaintDailyStats rollup from the complaints table'
+
+    def handle(self, *args, **options):
+        buckets = ComplaintDailyStats.rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {len(buckets)} daily buckets covering {sum(b.count for b in buckets)} complaints"
+        ))
@@ -5,10 +5,16 @@ from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
-from tgbot.bot.loader import bot, dp
+from tgbot.bot.loader import (
+    bot, dp, location_manager, location_keyboards, LOCATIONS_WATCH_INTERVAL, FSM_SWEEP_INTERVAL, METRICS_INTERVAL
+)
 from tgbot.bot.handlers.users import start, complaint, admin as admin_handler
 from tgbot.bot.handlers.errors import error_handler
-from tgbot.bot.middlewares.throttling import ThrottlingMiddleware
+from tgbot.bot import broadcast, repository
+from tgbot.bot.middlewares.database import DatabaseConnectionMiddleware
+from tgbot.bot.middlewares.throttling import ThrottlingMiddleware, RedisThrottlingMiddleware
+from tgbot.bot.middlewares.user_cache import TelegramUserMiddleware, user_cache
+from tgbot.bot.storage import sweep_forever
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,6 +22,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks = set()
+
+
+async def report_metrics(interval):
+    """Log database, statistics cache and user cache counters every ``interval`` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(
+            "Metrics: db=%s stats_cache=%s user_cache=%s",
+            repository.connection_stats(), repository.statistics_cache.stats(), user_cache.stats()
+        )
+
 
 class Command(BaseCommand):
     help = 'Run Telegram Bot'
@@ -28,11 +46,36 @@ class Command(BaseCommand):
 async def on_startup():
     logger.info("Bot is starting up...")
     await bot.delete_webhook(drop_pending_updates=True)
-    dp.message.middleware(ThrottlingMiddleware(time_limit=0.5))
+    redis = getattr(dp.fsm.storage, 'redis', None)
+    if redis is not None:
+        # Budgets are shared by every bot process through Redis
+        message_throttling = RedisThrottlingMiddleware(redis, 'message', rate=2, burst=3)
+        callback_throttling = RedisThrottlingMiddleware(redis, 'callback', rate=5, burst=10, lease=3)
+    else:
+        message_throttling = ThrottlingMiddleware(rate=2, burst=3)
+        callback_throttling = ThrottlingMiddleware(rate=5, burst=10)
+    dp.update.outer_middleware(DatabaseConnectionMiddleware())
+    dp.update.outer_middleware(TelegramUserMiddleware(user_cache))
+    dp.message.middleware(message_throttling)
+    dp.callback_query.middleware(callback_throttling)
     dp.include_router(start.router)
     dp.include_router(complaint.router)
     dp.include_router(admin_handler.router)
     dp.include_router(error_handler.router)
+    location_keyboards.warm()
+    logger.info("Warmed %d location keyboards", len(location_keyboards))
+    location_manager.get_street_search_index()
+    if LOCATIONS_WATCH_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(location_manager.watch(LOCATIONS_WATCH_INTERVAL)))
+    if FSM_SWEEP_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(
+            sweep_forever(dp.fsm.storage, dp.fsm.events_isolation, FSM_SWEEP_INTERVAL, extra=[message_throttling, callback_throttling, user_cache])
+        ))
+    if METRICS_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(report_metrics(METRICS_INTERVAL)))
+    resumed = await broadcast.resume_unfinished(bot)
+    if resumed:
+        logger.info("Resumed %d unfinished broadcasts", resumed)
     from aiogram.types import (
         BotCommand,
         BotCommandScopeDefault,
@@ -62,6 +105,9 @@ async def on_startup():
 
 async def on_shutdown():
     logger.info("Bot is shutting down...")
+    for task in background_tasks:
+        task.cancel()
+    await broadcast.stop()
     await bot.session.close()
     logger.info("Bot stopped!")
 
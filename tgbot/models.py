@@ -1,4 +1,9 @@
-from django.db import models
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models.functions import TruncDate
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
@@ -44,6 +49,13 @@ class Complaint(models.Model):
         related_name='complaints',
         verbose_name=_("User")
     )
+    number = models.CharField(
+        max_length=20,
+        unique=True,
+        blank=True,
+        null=True,
+        verbose_name=_("Number")
+    )
     is_anonymous = models.BooleanField(default=False, verbose_name=_("Is Anonymous"))
 
     # Contact details
@@ -87,11 +99,39 @@ class Complaint(models.Model):
         indexes = [
             models.Index(fields=['status', '-created_at']),
             models.Index(fields=['region_id', '-created_at']),
+            models.Index(fields=['district_id', '-created_at']),
             models.Index(fields=['created_at']),
         ]
 
     def __str__(self):
-        return f"Complaint #{self.id} - {self.get_status_display()}"
+        return f"Complaint #{self.number or self.id} - {self.get_status_display()}"
+
+    def save(self, *args, **kwargs):
+        """Save and move this complaint between ComplaintDailyStats buckets.
+
+        The previous status is re-read under a row lock, so concurrent
+        status changes cannot count a complaint twice. bulk_create() and
+        queryset.update() bypass this; run ``rebuild_complaint_stats`` after
+        using them.
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'status', 'is_anonymous'} & set(update_fields):
+            return super().save(*args, **kwargs)
+
+        using = kwargs.get('using') or 'default'
+        with transaction.atomic(using=using, savepoint=False):
+            previous = None
+            if not self._state.adding:
+                previous = Complaint.objects.using(using).select_for_update().filter(
+                    pk=self.pk
+                ).values_list('status', 'is_anonymous', 'created_at').first()
+            super().save(*args, **kwargs)
+
+            if previous is not None and previous[:2] == (self.status, self.is_anonymous):
+                return
+            if previous is not None:
+                ComplaintDailyStats.add(timezone.localdate(previous[2]), previous[0], previous[1], -1, using)
+            ComplaintDailyStats.add(timezone.localdate(self.created_at), self.status, self.is_anonymous, 1, using)
 
     def get_full_address(self):
         """Get formatted full address"""
@@ -101,6 +141,91 @@ class Complaint(models.Model):
         return ', '.join(parts)
 
 
+class ComplaintCounter(models.Model):
+    """Last complaint number handed out in a year/month."""
+
+    year = models.PositiveSmallIntegerField(verbose_name=_("Year"))
+    month = models.PositiveSmallIntegerField(verbose_name=_("Month"))
+    value = models.PositiveIntegerField(default=0, verbose_name=_("Value"))
+
+    class Meta:
+        verbose_name = _("Complaint Counter")
+        verbose_name_plural = _("Complaint Counters")
+        constraints = [
+            models.UniqueConstraint(fields=['year', 'month'], name='unique_complaint_counter_period'),
+        ]
+
+    def __str__(self):
+        return f"{self.year}-{self.month}: {self.value}"
+
+
+class ComplaintDailyStats(models.Model):
+    """Number of complaints created on a day, by current status and anonymity.
+
+    Kept up to date by Complaint.save() and deletes, so statistics read
+    a few rows per day instead of scanning complaints. Every change bumps
+    a generation number in the cache, which retires cached statistics.
+    """
+
+    CACHE_GENERATION_KEY = 'tgbot:complaint_stats:generation'
+
+    date = models.DateField(verbose_name=_("Date"))
+    status = models.CharField(max_length=20, choices=Complaint.STATUS_CHOICES, verbose_name=_("Status"))
+    is_anonymous = models.BooleanField(verbose_name=_("Is Anonymous"))
+    count = models.IntegerField(default=0, verbose_name=_("Count"))
+
+    class Meta:
+        verbose_name = _("Complaint Daily Stats")
+        verbose_name_plural = _("Complaint Daily Stats")
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'status', 'is_anonymous'], name='unique_complaint_daily_stats'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.status}: {self.count}"
+
+    @classmethod
+    def add(cls, date, status, is_anonymous, delta, using='default'):
+        """Add ``delta`` to a bucket with a single upsert."""
+        connection = connections[using]
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (date, status, is_anonymous, count) VALUES (%s, %s, %s, %s) "
+                f"ON CONFLICT (date, status, is_anonymous) DO UPDATE SET count = {table}.count + EXCLUDED.count",
+                [connection.ops.adapt_datefield_value(date), status, is_anonymous, delta]
+            )
+        transaction.on_commit(cls.invalidate_cache, using=using)
+
+    @classmethod
+    def invalidate_cache(cls):
+        try:
+            cache.incr(cls.CACHE_GENERATION_KEY)
+        except ValueError:
+            cache.add(cls.CACHE_GENERATION_KEY, 1, timeout=None)
+
+    @classmethod
+    def rebuild(cls, using='default'):
+        """Recompute every bucket from the complaints table in one GROUP BY."""
+        rows = (
+            Complaint.objects.using(using)
+            .annotate(date=TruncDate('created_at'))
+            .order_by()
+            .values('date', 'status', 'is_anonymous')
+            .annotate(count=models.Count('id'))
+        )
+        with transaction.atomic(using=using):
+            cls.objects.using(using).all().delete()
+            buckets = cls.objects.using(using).bulk_create(cls(**row) for row in rows)
+            transaction.on_commit(cls.invalidate_cache, using=using)
+        return buckets
+
+
+@receiver(post_delete, sender=Complaint)
+def uncount_deleted_complaint(sender, instance, using, **kwargs):
+    ComplaintDailyStats.add(timezone.localdate(instance.created_at), instance.status, instance.is_anonymous, -1, using)
+
+
 class ComplaintMedia(models.Model):
     FILE_TYPE_CHOICES = [
         ('photo', _('Photo')),
@@ -126,7 +251,7 @@ class ComplaintMedia(models.Model):
         ordering = ['created_at']
 
     def __str__(self):
-        return f"{self.get_file_type_display()} for Complaint #{self.complaint.id}"
+        return f"{self.get_file_type_display()} for Complaint #{self.complaint_id}"
 
     def preview(self):
         """Admin panelda faylni ko‘rsatish uchun"""
@@ -146,6 +271,11 @@ class BroadcastMessage(models.Model):
     created_by = models.CharField(max_length=255, verbose_name=_("Created By"))
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Created At"))
     completed_at = models.DateTimeField(blank=True, null=True, verbose_name=_("Completed At"))
+    # Checkpoint of an unfinished broadcast: every active user with an id up
+    # to last_user_id has been handled, the counts cover exactly those users
+    total_count = models.IntegerField(default=0, verbose_name=_("Total Count"))
+    last_user_id = models.BigIntegerField(default=0, verbose_name=_("Last User ID"))
+    chat_id = models.BigIntegerField(blank=True, null=True, verbose_name=_("Admin Chat ID"))
 
     class Meta:
         verbose_name = _("Broadcast Message")
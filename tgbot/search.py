@@ -0,0 +1,248 @@
+"""Complaint search for the admin changelist.
+
+On Postgres every complaint carries a ``search_vector`` tsvector, a
+stored generated column kept up to date by the database itself and
+indexed with GIN. Names, organisations and phone numbers additionally
+get pg_trgm GIN indexes so substring matches stay indexed too. Matches
+are ordered by ``ts_rank`` and ``ts_headline`` marks the matched words.
+
+SQLite has neither, so local runs use an FTS5 table over the same
+columns, kept in sync with triggers, ranked with ``bm25``. SQLite builds
+without FTS5 get the admin's plain substring search.
+
+The column, indexes, table and triggers are not model fields: they are
+created by ``install()``, which runs after every ``migrate``.
+"""
+import logging
+import re
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVectorField
+from django.db import DatabaseError, OperationalError, connections, transaction
+from django.db.models import FloatField, Q, TextField
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from tgbot.models import Complaint
+
+logger = logging.getLogger(__name__)
+
+TABLE = Complaint._meta.db_table
+FTS_TABLE = f"{TABLE}_fts"
+
+# Postgres dictionaries don't cover Uzbek, so words are only lowercased
+SEARCH_CONFIG = 'simple'
+
+# (column, weight): ts_rank weights A..D, bm25 weights on SQLite
+WEIGHTED_COLUMNS = (
+    ('target_full_name', 'A'),
+    ('target_organization', 'A'),
+    ('full_name', 'B'),
+    ('target_position', 'C'),
+    ('complaint_text', 'D'),
+)
+BM25_WEIGHTS = {'A': 4.0, 'B': 2.0, 'C': 1.0, 'D': 1.0}
+
+# Matched as substrings (icontains); pg_trgm only helps from 3 characters
+TRIGRAM_COLUMNS = ('target_full_name', 'target_organization', 'full_name', 'phone_number')
+MIN_TRIGRAM_LENGTH = 3
+
+# Private-use characters around highlighted words, turned into <mark> after escaping
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_STOP = '\ue001'
+
+
+def _postgres_statements():
+    vector = ' || '.join(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({column}, '')), '{weight}')"
+        for column, weight in WEIGHTED_COLUMNS
+    )
+    yield (
+        f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        f"GENERATED ALWAYS AS ({vector}) STORED"
+    )
+    yield f"CREATE INDEX IF NOT EXISTS {TABLE}_search_vector ON {TABLE} USING gin (search_vector)"
+
+
+def _trigram_statements():
+    yield "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+    # icontains compares UPPER(column), so that is what gets indexed
+    for column in TRIGRAM_COLUMNS:
+        yield (
+            f"CREATE INDEX IF NOT EXISTS {TABLE}_{column}_trgm ON {TABLE} "
+            f"USING gin (UPPER({column}) gin_trgm_ops)"
+        )
+
+
+def _sqlite_table_statement():
+    names = ', '.join(column for column, _ in WEIGHTED_COLUMNS)
+    return (
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5({names}, content='{TABLE}', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+
+
+def _sqlite_triggers():
+    columns = [column for column, _ in WEIGHTED_COLUMNS]
+    names = ', '.join(columns)
+    new = ', '.join(f"new.{column}" for column in columns)
+    old = ', '.join(f"old.{column}" for column in columns)
+    delete = f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    insert = f"INSERT INTO {FTS_TABLE} (rowid, {names}) VALUES (new.id, {new});"
+
+    return {
+        f"{FTS_TABLE}_insert": f"AFTER INSERT ON {TABLE} BEGIN {insert} END",
+        f"{FTS_TABLE}_delete": f"AFTER DELETE ON {TABLE} BEGIN {delete} END",
+        f"{FTS_TABLE}_update": f"AFTER UPDATE ON {TABLE} BEGIN {delete} {insert} END",
+    }
+
+
+def _has_fts_table(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+    return cursor.fetchone() is not None
+
+
+def _install_sqlite(cursor, using):
+    # Django rebuilds a SQLite table for most ALTERs, which drops its triggers,
+    # so they are checked on every migrate and the index rebuilt if any was missing
+    created = not _has_fts_table(cursor)
+    if created:
+        try:
+            with transaction.atomic(using):
+                cursor.execute(_sqlite_table_statement())
+        except OperationalError:
+            logger.warning("SQLite has no FTS5; complaint search falls back to substring matches", exc_info=True)
+            return
+
+    triggers = _sqlite_triggers()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [TABLE])
+    missing = set(triggers) - {row[0] for row in cursor.fetchall()}
+    if not created and not missing:
+        return
+
+    with transaction.atomic(using):
+        for name, body in triggers.items():
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+    logger.info("Rebuilt the complaint search index")
+
+
+def install(using='default'):
+    """Create the search column, indexes or FTS table and triggers if they are missing."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if TABLE not in connection.introspection.table_names(cursor):
+            return
+
+        if connection.vendor == 'postgresql':
+            for sql in _postgres_statements():
+                cursor.execute(sql)
+            try:
+                with transaction.atomic(using):
+                    for sql in _trigram_statements():
+                        cursor.execute(sql)
+            except DatabaseError:
+                logger.warning("pg_trgm is unavailable; substring search runs without indexes", exc_info=True)
+
+        elif connection.vendor == 'sqlite':
+            _install_sqlite(cursor, using)
+
+
+def install_after_migrate(sender, using='default', **kwargs):
+    install(using)
+
+
+def search_words(term):
+    return re.findall(r'\w+', term)
+
+
+def _text_conditions(term):
+    conditions = Q()
+    if len(term) >= MIN_TRIGRAM_LENGTH:
+        for column in TRIGRAM_COLUMNS:
+            conditions |= Q(**{f"{column}__icontains": term})
+    if term.isdigit():
+        conditions |= Q(pk=int(term))
+    return conditions | Q(number=term)
+
+
+def _search_postgres(queryset, term, words):
+    query = SearchQuery(
+        ' & '.join(f"{word}:*" for word in words),
+        config=SEARCH_CONFIG,
+        search_type='raw'
+    )
+    document = RawSQL(f"{TABLE}.search_vector", [], output_field=SearchVectorField())
+    return (
+        queryset
+        .alias(search_document=document, search_rank=SearchRank(document, query))
+        .annotate(search_headline=SearchHeadline(
+            'complaint_text',
+            query,
+            config=SEARCH_CONFIG,
+            start_sel=HIGHLIGHT_START,
+            stop_sel=HIGHLIGHT_STOP,
+            max_words=25,
+            min_words=10,
+        ))
+        .filter(Q(search_document=query) | _text_conditions(term))
+    )
+
+
+def _search_sqlite(queryset, term, words):
+    match = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+    weights = ', '.join(str(BM25_WEIGHTS[weight]) for _, weight in WEIGHTED_COLUMNS)
+    text_column = [column for column, _ in WEIGHTED_COLUMNS].index('complaint_text')
+
+    def per_row(expression):
+        return (
+            f"(SELECT {expression} FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = {TABLE}.id)"
+        )
+
+    return (
+        queryset
+        .alias(search_rank=RawSQL(
+            f"COALESCE({per_row(f'-bm25({FTS_TABLE}, {weights})')}, 0)", (match,), output_field=FloatField()
+        ))
+        .annotate(search_headline=RawSQL(
+            per_row(f"snippet({FTS_TABLE}, {text_column}, %s, %s, '…', 25)"),
+            (HIGHLIGHT_START, HIGHLIGHT_STOP, match),
+            output_field=TextField()
+        ))
+        .filter(
+            Q(pk__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", (match,)))
+            | _text_conditions(term)
+        )
+    )
+
+
+def search_complaints(queryset, term):
+    """Filter ``queryset`` to complaints matching ``term``.
+
+    Adds a ``search_rank`` alias to order by and a ``search_headline``
+    annotation with the matched words of the complaint text, or returns
+    None when the database has no full-text search (the caller then falls
+    back to plain substring matches).
+    """
+    term = term.strip()
+    words = search_words(term)
+    vendor = connections[queryset.db].vendor
+    if not words:
+        return queryset.filter(_text_conditions(term)) if term else queryset
+    if vendor == 'postgresql':
+        return _search_postgres(queryset, term, words)
+    if vendor == 'sqlite':
+        with connections[queryset.db].cursor() as cursor:
+            if _has_fts_table(cursor):
+                return _search_sqlite(queryset, term, words)
+    return None
+
+
+def highlight(headline):
+    """Escape a headline and mark its matched words."""
+    if not headline:
+        return '-'
+    return mark_safe(
+        escape(headline).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+    )
@@ -1,3 +1,1113 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import GetFile, SendMessage
+from aiogram.types import CallbackQuery, Chat, File, Message, PhotoSize, Update, User as TgUser
+from asgiref.sync import async_to_sync
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+from django.db.models import Count, Q
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import fakeredis
+import openpyxl
+
+from tgbot.admin import EXPORT_HEADERS
+from tgbot.bot import broadcast, exports, repository
+from tgbot.bot.keyboards.reply import LocationKeyboardCache
+from tgbot.bot.loader import bot, dp
+from tgbot.bot.locations import LocationManager, LocationSnapshot, compile_snapshot
+from tgbot.bot.middlewares.database import DatabaseConnectionMiddleware
+from tgbot.bot.middlewares.throttling import RedisThrottlingMiddleware, ThrottlingMiddleware
+from tgbot.bot.middlewares.user_cache import TelegramUserMiddleware, user_cache
+from tgbot.bot.storage import PrunableEventIsolation
+from tgbot.changelist import DistrictFilter, EstimatedCountPaginator
+from tgbot import search
+from tgbot.search import highlight, search_complaints
+from tgbot.models import Complaint, ComplaintDailyStats, ComplaintMedia, TelegramUser
+
+
+COMPLAINT_FIELDS = dict(
+    is_anonymous=False,
+    full_name='Ali Valiyev',
+    phone_number='+998901234567',
+    region_id=1,
+    region_name='Toshkent',
+    district_id=15,
+    district_name='Chilonzor',
+    street_id=1,
+    street_name='Navro‘z',
+    target_full_name='Bek Bekov',
+    target_position='Boshliq',
+    target_organization='Hokimiyat',
+    complaint_text='x' * 40,
+    status='new',
+)
+
+
+class SaveComplaintTests(TransactionTestCase):
+
+    def test_media_are_inserted_in_one_statement(self):
+        media_files = [
+            {'file_id': f'file-{i}', 'file_type': 'photo'}
+            for i in range(10)
+        ]
+
+        # BEGIN, counter upsert, complaint INSERT, stats upsert, one media INSERT, COMMIT
+        with self.assertNumQueries(6):
+            complaint = repository.save_complaint(media_files, **COMPLAINT_FIELDS)
+
+        self.assertEqual(complaint.media_files.count(), 10)
+
+    def test_without_media_only_the_complaint_is_inserted(self):
+        with self.assertNumQueries(5):
+            repository.save_complaint([], **COMPLAINT_FIELDS)
+
+    def test_failed_media_insert_rolls_back_the_complaint(self):
+        with self.assertRaises(KeyError):
+            repository.save_complaint([{'file_type': 'photo'}], **COMPLAINT_FIELDS)
+
+        self.assertFalse(Complaint.objects.exists())
+        self.assertFalse(ComplaintMedia.objects.exists())
+
+
+class ComplaintNumberTests(TransactionTestCase):
+
+    def test_numbers_are_sequential_within_a_month(self):
+        numbers = [repository.next_complaint_number(date(2025, 3, day)) for day in (1, 2, 31)]
+
+        self.assertEqual(numbers, ['2025-3-1', '2025-3-2', '2025-3-3'])
+
+    def test_each_month_starts_from_one(self):
+        repository.next_complaint_number(date(2025, 3, 31))
+
+        self.assertEqual(repository.next_complaint_number(date(2025, 4, 1)), '2025-4-1')
+        self.assertEqual(repository.next_complaint_number(date(2026, 3, 1)), '2026-3-1')
+
+    def test_rolled_back_complaint_does_not_leave_a_gap(self):
+        with self.assertRaises(KeyError):
+            repository.save_complaint([{'file_type': 'photo'}], **COMPLAINT_FIELDS)
+
+        first = repository.save_complaint([], **COMPLAINT_FIELDS)
+        second = repository.save_complaint([], **COMPLAINT_FIELDS)
+
+        self.assertEqual(first.number.rsplit('-', 1)[1], '1')
+        self.assertEqual(second.number.rsplit('-', 1)[1], '2')
+
+
+class RegisterUserTests(TransactionTestCase):
+
+    def from_user(self, **profile):
+        return SimpleNamespace(**{'id': 42, 'username': 'ali', 'first_name': 'Ali', 'last_name': None, **profile})
+
+    def test_new_user_is_inserted_in_one_statement(self):
+        with self.assertNumQueries(1):
+            user = repository.upsert_user(42, {'username': 'ali', 'first_name': 'Ali', 'last_name': None})
+
+        self.assertEqual(user.telegram_id, 42)
+        self.assertEqual(user.language, 'uz')
+        self.assertEqual(TelegramUser.objects.get().username, 'ali')
+
+    def test_upsert_does_not_rewrite_an_unchanged_row(self):
+        user = repository.upsert_user(42, {'username': 'ali', 'first_name': 'Ali', 'last_name': None})
+
+        again = repository.upsert_user(42, {'username': 'ali', 'first_name': 'Ali', 'last_name': None})
+
+        self.assertEqual(again.pk, user.pk)
+        self.assertEqual(TelegramUser.objects.get().updated_at, user.updated_at)
+
+    def test_upsert_refreshes_a_changed_profile(self):
+        repository.upsert_user(42, {'username': 'ali', 'first_name': 'Ali', 'last_name': None})
+
+        with self.assertNumQueries(1):
+            user = repository.upsert_user(42, {'username': 'vali', 'first_name': 'Ali', 'last_name': None})
+
+        self.assertEqual(user.username, 'vali')
+        self.assertEqual(TelegramUser.objects.count(), 1)
+
+    def test_cached_unchanged_user_costs_no_query(self):
+        user = TelegramUser.objects.create(telegram_id=42, username='ali', first_name='Ali')
+
+        with self.assertNumQueries(0):
+            result = async_to_sync(repository.register_user)(self.from_user(), user)
+
+        self.assertIs(result, user)
+
+    def test_cached_changed_user_updates_only_profile_columns(self):
+        user = TelegramUser.objects.create(telegram_id=42, username='ali', first_name='Ali', language='ru')
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(repository.register_user)(self.from_user(username='vali'), user)
+
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('UPDATE'))
+        self.assertNotIn('language', queries[0]['sql'])
+        self.assertEqual(TelegramUser.objects.get().username, 'vali')
+
+
+class ComplaintStatisticsTests(TransactionTestCase):
+
+    def live_statistics(self):
+        today = timezone.localdate()
+
+        def since(day):
+            return Q(created_at__gte=timezone.make_aware(datetime.combine(day, time.min)))
+
+        return Complaint.objects.aggregate(
+            total=Count('id'),
+            new=Count('id', filter=Q(status='new')),
+            in_progress=Count('id', filter=Q(status='in_progress')),
+            resolved=Count('id', filter=Q(status='resolved')),
+            rejected=Count('id', filter=Q(status='rejected')),
+            today=Count('id', filter=since(today)),
+            week=Count('id', filter=since(today - timedelta(days=6))),
+            month=Count('id', filter=since(today - timedelta(days=29))),
+            anonymous=Count('id', filter=Q(is_anonymous=True)),
+        )
+
+    def create_complaints(self):
+        complaints = [
+            repository.save_complaint([], **{**COMPLAINT_FIELDS, 'is_anonymous': i % 3 == 0})
+            for i in range(9)
+        ]
+        for days_ago, complaint in zip((0, 3, 10, 40), complaints):
+            Complaint.objects.filter(pk=complaint.pk).update(
+                created_at=timezone.now() - timedelta(days=days_ago)
+            )
+        ComplaintDailyStats.rebuild()
+        return list(Complaint.objects.order_by('pk'))
+
+    def test_statistics_come_from_one_aggregate(self):
+        self.create_complaints()
+
+        # one aggregate over the rollup plus the user count
+        with self.assertNumQueries(2):
+            stats = repository.complaint_statistics()
+
+        self.assertEqual(stats.pop('users'), 0)
+        self.assertEqual(stats, self.live_statistics())
+
+    def test_rollup_follows_status_changes_and_deletes(self):
+        complaints = self.create_complaints()
+
+        complaints[0].status = 'resolved'
+        complaints[0].save(update_fields=['status', 'updated_at'])
+        complaints[1].status = 'rejected'
+        complaints[1].save()
+        complaints[2].admin_notes = 'checked'
+        complaints[2].save(update_fields=['admin_notes', 'updated_at'])
+        complaints[3].delete()
+        Complaint.objects.filter(pk__in=[complaints[4].pk, complaints[5].pk]).delete()
+
+        stats = repository.complaint_statistics()
+        stats.pop('users')
+        self.assertEqual(stats, self.live_statistics())
+        self.assertEqual(stats['resolved'], 1)
+        self.assertEqual(stats['total'], 6)
+
+        incremental = set(ComplaintDailyStats.objects.exclude(count=0).values_list('date', 'status', 'is_anonymous', 'count'))
+        ComplaintDailyStats.rebuild()
+        self.assertEqual(incremental, set(ComplaintDailyStats.objects.values_list('date', 'status', 'is_anonymous', 'count')))
+
+
+class EventIsolationTests(SimpleTestCase):
+
+    def test_prune_keeps_the_lock_of_a_queued_update(self):
+        isolation = PrunableEventIsolation()
+        running = []
+        overlapped = []
+        later = []
+
+        async def handle(name):
+            async with isolation.lock('chat'):
+                running.append(name)
+                overlapped.append(len(running) > 1)
+                await asyncio.sleep(0.01)
+                running.remove(name)
+            if name == 'first':
+                # Released, but the queued update has not woken up yet
+                isolation.prune()
+                later.append(asyncio.ensure_future(handle('third')))
+
+        async def updates():
+            first = asyncio.ensure_future(handle('first'))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(handle('second'))
+            await asyncio.gather(first, second)
+            await asyncio.gather(*later)
+
+        async_to_sync(updates)()
+
+        self.assertEqual(overlapped, [False, False, False])
+        self.assertEqual(isolation.prune(), 0)
+        self.assertFalse(isolation._locks)
+
+
+def callback_query(user_id=1, data='x'):
+    return CallbackQuery(
+        id='1', from_user=TgUser(id=user_id, is_bot=False, first_name='Ali'), chat_instance='1', data=data
+    )
+
+
+class ThrottlingTests(SimpleTestCase):
+
+    def test_throttled_callback_is_answered(self):
+        throttling = ThrottlingMiddleware(rate=1, burst=1)
+        handler = mock.AsyncMock()
+
+        with mock.patch.object(CallbackQuery, 'answer', new_callable=mock.AsyncMock) as answer:
+            for _ in range(2):
+                async_to_sync(throttling)(handler, callback_query(), {})
+
+        self.assertEqual(handler.await_count, 1)
+        answer.assert_awaited_once()
+
+
+class RedisThrottlingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def middleware(self, **kwargs):
+        redis = fakeredis.FakeAsyncRedis(server=self.server)
+        return RedisThrottlingMiddleware(redis, 'message', **{'rate': 2, 'burst': 3, **kwargs})
+
+    def checks(self, *middlewares):
+        async def check():
+            return [await middleware.check(1) for middleware in middlewares]
+        return async_to_sync(check)()
+
+    def test_processes_share_one_budget(self):
+        first, second = self.middleware(lease=1), self.middleware(lease=1)
+
+        self.assertEqual(self.checks(first, second, first, second), [True, True, True, False])
+        self.assertEqual((first.redis_calls, second.redis_calls), (2, 2))
+
+    def test_lease_is_spent_without_asking_redis(self):
+        throttling = self.middleware(lease=2)
+
+        self.assertEqual(self.checks(*[throttling] * 4), [True, True, True, False])
+        # The lease from the first call covers the second
+        self.assertEqual(throttling.redis_calls, 3)
+
+    def test_unreachable_redis_falls_back_to_the_local_bucket(self):
+        throttling = self.middleware()
+        self.server.connected = False
+
+        with self.assertLogs('tgbot.bot.middlewares.throttling', 'WARNING'):
+            results = self.checks(*[throttling] * 4)
+
+        self.assertEqual(results, [True, True, True, False])
+        self.assertIn(1, throttling.arrivals)
+
+
+class LocationSnapshotTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.json_path = os.path.join(self.directory, 'locations.json')
+        self.snapshot_path = os.path.join(self.directory, 'locations.bin')
+        self.write_json('Toshkent')
+
+    def write_json(self, region_name, mtime=None):
+        with open(self.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'regions': [{'id': 1, 'name': region_name}],
+                'districts': [{'id': 15, 'region_id': 1, 'name': 'Chilonzor'}],
+                'quarters': [{'id': 1, 'district_id': 15, 'name': 'Navro‘z'}],
+            }, f)
+        if mtime is not None:
+            os.utime(self.json_path, (mtime, mtime))
+
+    def test_concurrent_compiles_do_not_collide(self):
+        errors = []
+
+        def compile_():
+            try:
+                compile_snapshot(self.json_path, self.snapshot_path)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=compile_) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['locations.bin', 'locations.json'])
+        self.assertEqual(LocationSnapshot(self.snapshot_path).regions.get(1)['name'], 'Toshkent')
+
+    def test_snapshot_matches_the_json_tables(self):
+        with open(self.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'regions': [{'id': 1, 'name': 'Toshkent'}, {'id': 3, 'name': 'Samarqand'}],
+                'districts': [{'id': 15, 'region_id': 3, 'name': 'Urgut'}, {'id': 7, 'region_id': 1, 'name': 'Chilonzor'}],
+                'quarters': [{'id': 1, 'district_id': 15, 'name': 'Navro‘z'}, {'id': 2, 'district_id': 15, 'name': 'Bog‘'}],
+            }, f)
+        compile_snapshot(self.json_path, self.snapshot_path)
+        snapshot = LocationSnapshot(self.snapshot_path)
+
+        self.assertEqual(snapshot.regions.get(3), {'id': 3, 'name': 'Samarqand'})
+        for missing in (None, -1, 0, 2, 4, 10 ** 6):
+            self.assertIsNone(snapshot.regions.get(missing))
+        self.assertEqual(snapshot.districts.get(7), {'id': 7, 'region_id': 1, 'name': 'Chilonzor'})
+        streets = snapshot.streets.children(15)
+        self.assertEqual(len(streets), 2)
+        self.assertEqual([street['name'] for street in streets], ['Navro‘z', 'Bog‘'])
+        self.assertEqual(streets[-1:], ({'id': 2, 'district_id': 15, 'name': 'Bog‘'},))
+        self.assertEqual(len(snapshot.streets.children(99)), 0)
+
+    def test_snapshot_in_an_older_format_is_recompiled(self):
+        with open(self.snapshot_path, 'wb') as f:
+            f.write(b'LOCS' + bytes(64))
+        os.utime(self.snapshot_path, (os.path.getmtime(self.json_path) + 10,) * 2)
+
+        with self.assertLogs('tgbot.bot.locations', 'WARNING'):
+            tables = LocationManager(self.json_path, self.snapshot_path).tables
+
+        self.assertIsInstance(tables, LocationSnapshot)
+        self.assertEqual(tables.regions.get(1)['name'], 'Toshkent')
+
+    def test_reader_reopens_the_snapshot_without_recompiling_it(self):
+        compile_snapshot(self.json_path, self.snapshot_path)
+        reader = LocationManager(self.json_path, self.snapshot_path, rebuild_snapshot=False)
+        self.assertIsInstance(reader.tables, LocationSnapshot)
+
+        self.write_json('Samarqand', mtime=os.path.getmtime(self.snapshot_path) + 10)
+        with mock.patch('tgbot.bot.locations.compile_snapshot') as compile_:
+            reader.reload()
+
+        compile_.assert_not_called()
+        self.assertEqual(reader.get_region_by_id(1)['name'], 'Samarqand')
+
+        compile_snapshot(self.json_path, self.snapshot_path)
+        os.utime(self.snapshot_path, (os.path.getmtime(self.json_path) + 10,) * 2)
+        reader.reload()
+        self.assertIsInstance(reader.tables, LocationSnapshot)
+
+
+class LocationKeyboardCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        json_path = os.path.join(directory.name, 'locations.json')
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'regions': [{'id': 1, 'name': 'Toshkent'}],
+                'districts': [{'id': 15, 'region_id': 1, 'name': 'Chilonzor'}],
+                'quarters': [{'id': i, 'district_id': 15, 'name': f'Mahalla {i}'} for i in range(1, 6)],
+            }, f)
+        self.manager = LocationManager(json_path, os.path.join(directory.name, 'locations.bin'))
+        self.keyboards = LocationKeyboardCache(self.manager, per_page=2)
+
+    def test_cached_page_does_not_load_streets(self):
+        first = self.keyboards.mahallas(15, page=2)
+
+        with mock.patch.object(self.manager, 'get_streets_by_district') as streets:
+            self.assertIs(self.keyboards.mahallas(15, page=2), first)
+        streets.assert_not_called()
+
+    def test_forged_pages_and_districts_are_not_cached(self):
+        for district_id, page in ((15, 3), (15, -1), (15, 10 ** 6), (99, 0)):
+            self.keyboards.mahallas(district_id, page=page)
+        self.assertEqual(len(self.keyboards), 0)
+
+        for page in range(3):
+            self.keyboards.mahallas(15, page=page)
+        self.assertEqual(len(self.keyboards), 3)
+
+
+class StatisticsCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.statistics_cache = repository.StatisticsCache(ttl=60)
+
+    def test_concurrent_requests_share_one_computation(self):
+        async def burst():
+            return await asyncio.gather(*(self.statistics_cache.get() for _ in range(10)))
+
+        with mock.patch.object(repository, 'complaint_statistics', wraps=repository.complaint_statistics) as compute:
+            results = async_to_sync(burst)()
+            async_to_sync(self.statistics_cache.get)()
+
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(len({id(result) for result in results}), 1)
+        self.assertEqual(
+            self.statistics_cache.stats(),
+            {'hits': 1, 'misses': 1, 'shared': 9, 'hit_ratio': 0.909}
+        )
+
+    def test_complaint_changes_retire_cached_statistics(self):
+        get = async_to_sync(self.statistics_cache.get)
+        self.assertEqual(get()['total'], 0)
+
+        complaint = repository.save_complaint([], **COMPLAINT_FIELDS)
+        self.assertEqual(get()['total'], 1)
+        self.assertEqual(get()['new'], 1)
+
+        complaint.status = 'resolved'
+        complaint.save(update_fields=['status', 'updated_at'])
+        stats = get()
+        self.assertEqual((stats['new'], stats['resolved']), (0, 1))
+        self.assertEqual(self.statistics_cache.misses, 3)
+
+
+class ExportTests(TransactionTestCase):
+
+    def read_part(self, part):
+        with zipfile.ZipFile(part.file) as archive:
+            [name] = archive.namelist()
+            with archive.open(name) as entry:
+                return list(csv.reader(io.TextIOWrapper(entry, encoding='utf-8-sig')))
+
+    def test_rows_are_split_into_complete_parts(self):
+        numbers = [repository.save_complaint([], **COMPLAINT_FIELDS).number for _ in range(5)]
+        parts = []
+
+        exports.write_parts(parts.append, {'rows': 0}, threading.Event(), part_size=0, chunk_size=2)
+
+        self.assertEqual([part.rows for part in parts], [2, 2, 1])
+        rows = []
+        for part in parts:
+            header, *part_rows = self.read_part(part)
+            self.assertEqual(header, exports.HEADERS)
+            rows += part_rows
+        self.assertEqual([row[1] for row in rows], numbers[::-1])
+
+    def test_stopped_export_is_aborted(self):
+        for _ in range(3):
+            repository.save_complaint([], **COMPLAINT_FIELDS)
+        stopped = threading.Event()
+        stopped.set()
+
+        with self.assertRaises(exports.ExportAborted):
+            exports.write_parts(mock.Mock(), {'rows': 0}, stopped, chunk_size=1)
+
+
+class AdminExportTests(TransactionTestCase):
+
+    def setUp(self):
+        self.model_admin = site._registry[Complaint]
+        self.request = RequestFactory().post('/admin/tgbot/complaint/')
+        self.complaints = [
+            repository.save_complaint([], **{**COMPLAINT_FIELDS, 'complaint_text': f'text {i}\x07'})
+            for i in range(3)
+        ]
+
+    def test_csv_is_streamed(self):
+        response = self.model_admin.export_to_csv(self.request, Complaint.objects.all())
+
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        header, *rows = csv.reader(io.StringIO(content))
+        self.assertEqual(header, EXPORT_HEADERS)
+        self.assertEqual([row[1] for row in rows], [complaint.number for complaint in reversed(self.complaints)])
+
+    def test_excel_is_written_in_write_only_mode(self):
+        selected = Complaint.objects.filter(pk__in=[self.complaints[0].pk, self.complaints[2].pk])
+
+        response = self.model_admin.export_to_excel(self.request, selected)
+
+        worksheet = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        header, *rows = worksheet.values
+        self.assertEqual(list(header), EXPORT_HEADERS)
+        self.assertEqual([row[0] for row in rows], [self.complaints[2].pk, self.complaints[0].pk])
+        self.assertEqual(rows[0][-1], 'text 2')
+
+
+class SearchTests(TransactionTestCase):
+
+    def create(self, **fields):
+        return repository.save_complaint([], **{**COMPLAINT_FIELDS, **fields})
+
+    def search(self, term):
+        return list(search_complaints(Complaint.objects.all(), term).order_by('-search_rank', '-pk'))
+
+    def test_words_are_matched_by_prefix_and_ranked(self):
+        in_text = self.create(complaint_text='Poraxo‘rlik haqida shikoyat: maktab direktori pul so‘radi')
+        in_name = self.create(target_full_name='Direktor Karimov', complaint_text='x' * 40)
+        self.create(complaint_text='Yo‘l ta’mirlanmagan')
+
+        self.assertEqual(self.search('direk'), [in_name, in_text])
+        self.assertEqual(self.search('maktab pul'), [in_text])
+
+    def test_names_and_organisations_match_substrings(self):
+        complaint = self.create(target_organization='Toshkent shahar hokimiyati')
+        self.create(target_organization='Soliq inspeksiyasi')
+
+        self.assertEqual(self.search('hokimiyat'), [complaint])
+        self.assertEqual(self.search('kimiya'), [complaint])
+
+    def test_number_and_id_match_exactly(self):
+        complaint = self.create()
+        self.create()
+
+        self.assertEqual(self.search(complaint.number), [complaint])
+        self.assertEqual(self.search(str(complaint.pk)), [complaint])
+
+    def test_index_follows_updates_and_deletes(self):
+        complaint = self.create(complaint_text='Eski matn')
+        complaint.complaint_text = 'Yangi matn'
+        complaint.save()
+
+        self.assertEqual(self.search('eski'), [])
+        self.assertEqual(self.search('yangi'), [complaint])
+        complaint.delete()
+        self.assertEqual(self.search('yangi'), [])
+
+    def test_headline_is_escaped_and_marked(self):
+        self.create(complaint_text='Pora & sovg‘a so‘radi, 5 > 3')
+
+        [result] = search_complaints(Complaint.objects.all(), 'pora')
+
+        self.assertEqual(highlight(result.search_headline).count('<mark>'), 1)
+        self.assertIn('&amp;', highlight(result.search_headline))
+
+    def test_changelist_orders_by_rank(self):
+        in_text = self.create(complaint_text='Hokim yordamchisi javob bermadi')
+        in_name = self.create(target_full_name='Hokim Aliyev')
+        self.client.force_login(User.objects.create_superuser('admin', password='x'))
+
+        response = self.client.get(reverse('admin:tgbot_complaint_changelist'), {'q': 'hokim'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['cl'].result_list), [in_name, in_text])
+        self.assertContains(response, '<mark>')
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite rebuilds tables on ALTER")
+    def test_table_rebuild_restores_the_triggers_and_the_index(self):
+        before = self.create(complaint_text='Birinchi shikoyat')
+        with connection.schema_editor() as editor:
+            editor._remake_table(Complaint)
+        during = self.create(complaint_text='Ikkinchi shikoyat')
+        self.assertEqual(self.search('ikkinchi'), [])
+
+        search.install()
+
+        self.assertEqual(self.search('ikkinchi'), [during])
+        self.assertEqual(self.search('birinchi'), [before])
+        after = self.create(complaint_text='Uchinchi shikoyat')
+        self.assertEqual(self.search('uchinchi'), [after])
+
+    @skipUnless(connection.vendor == 'sqlite', "FTS5 is SQLite's")
+    def test_sqlite_without_fts5_falls_back_to_substring_search(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {search.FTS_TABLE}")
+            for name in search._sqlite_triggers():
+                cursor.execute(f"DROP TRIGGER {name}")
+        self.addCleanup(search.install)
+        missing_module = f"CREATE VIRTUAL TABLE {search.FTS_TABLE} USING no_such_module(x)"
+
+        with mock.patch.object(search, '_sqlite_table_statement', return_value=missing_module), \
+                self.assertLogs('tgbot.search', 'WARNING'):
+            search.install()
+
+        self.assertIsNone(search_complaints(Complaint.objects.all(), 'pora'))
+        complaint = self.create(target_organization='Soliq inspeksiyasi')
+        self.client.force_login(User.objects.create_superuser('admin', password='x'))
+        response = self.client.get(reverse('admin:tgbot_complaint_changelist'), {'q': 'Soliq'})
+        self.assertEqual(list(response.context['cl'].result_list), [complaint])
+
+
+class ComplaintChangeListTests(TransactionTestCase):
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='x'))
+        self.url = reverse('admin:tgbot_complaint_changelist')
+        now = timezone.now()
+        self.complaints = []
+        for i in range(5):
+            complaint = repository.save_complaint([], **COMPLAINT_FIELDS)
+            # two complaints share a timestamp so the id has to break the tie
+            Complaint.objects.filter(pk=complaint.pk).update(created_at=now - timedelta(minutes=min(i, 3)))
+            self.complaints.append(complaint)
+        self.newest_first = [self.complaints[0].pk, self.complaints[1].pk, self.complaints[2].pk,
+                             self.complaints[4].pk, self.complaints[3].pk]
+
+    def page(self, url, params=None):
+        with mock.patch.object(site._registry[Complaint], 'list_per_page', 2):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def test_pages_are_walked_with_a_keyset(self):
+        pages = []
+        cl = self.page(self.url)
+        self.assertIsNone(cl.newer_url)
+        while True:
+            pages.append([complaint.pk for complaint in cl.result_list])
+            if not cl.older_url:
+                break
+            cl = self.page(self.url + cl.older_url)
+
+        self.assertEqual(pages, [self.newest_first[:2], self.newest_first[2:4], self.newest_first[4:]])
+        back = self.page(self.url + cl.newer_url)
+        self.assertEqual([complaint.pk for complaint in back.result_list], self.newest_first[2:4])
+        self.assertTrue(back.keyset_pagination)
+
+    def test_sorting_by_a_column_keeps_numbered_pages(self):
+        cl = self.page(self.url, {'o': '1'})
+
+        self.assertFalse(cl.keyset_pagination)
+        self.assertEqual(cl.paginator.num_pages, 3)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'after': 'nonsense'})
+
+        self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_region_and_district_filter_on_ids_without_distinct(self):
+        other = repository.save_complaint([], **{**COMPLAINT_FIELDS, 'region_id': 2, 'district_id': 30})
+
+        with CaptureQueriesContext(connection) as queries:
+            cl = self.page(self.url, {'region': '2'})
+        self.assertEqual([complaint.pk for complaint in cl.result_list], [other.pk])
+        self.assertFalse([query for query in queries if 'DISTINCT' in query['sql']])
+
+        self.assertIn((30, mock.ANY), cl.filter_specs[-1].lookup_choices)
+        self.assertEqual(len(self.page(self.url, {'region': '1', 'district': '15'}).result_list), 2)
+        # no district list until a region is picked
+        self.assertNotIsInstance(self.page(self.url).filter_specs[-1], DistrictFilter)
+
+    def test_non_numeric_location_is_rejected(self):
+        for params in ({'region': 'abc'}, {'region': '1', 'district': 'x'}):
+            response = self.client.get(self.url, params)
+
+            self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_count_is_exact_only_up_to_the_threshold(self):
+        paginator = EstimatedCountPaginator(Complaint.objects.filter(status='new'), 2)
+        paginator.threshold = 3
+
+        self.assertGreaterEqual(paginator.count, 4)
+        self.assertTrue(paginator.estimated)
+
+        paginator = EstimatedCountPaginator(Complaint.objects.filter(status='new'), 2)
+        self.assertEqual(paginator.count, 5)
+        self.assertFalse(paginator.estimated)
+
+    def test_count_skips_the_annotations(self):
+        with CaptureQueriesContext(connection) as queries:
+            cl = self.page(self.url, {'q': 'Hokimiyat'})
+
+        self.assertEqual(cl.result_count, 5)
+        [count] = [query['sql'] for query in queries if query['sql'].startswith('SELECT COUNT(')]
+        for annotation in ('media_count', 'snippet', 'ts_headline', 'tgbot_complaintmedia'):
+            self.assertNotIn(annotation, count)
+
+
+class AdminQueryCountTests(TransactionTestCase):
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='x'))
+
+    def create(self, complaints, media_each):
+        media_files = [{'file_id': f'file-{i}', 'file_type': 'photo', 'file_name': '<b>x</b>'} for i in range(media_each)]
+        return [repository.save_complaint(media_files, **COMPLAINT_FIELDS) for _ in range(complaints)]
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def test_media_changelist_does_not_query_per_row(self):
+        url = reverse('admin:tgbot_complaintmedia_changelist')
+        self.create(1, 2)
+        few = self.queries(url)
+        self.create(10, 3)
+
+        self.assertEqual(len(self.queries(url)), len(few))
+
+    def test_complaint_changelist_counts_media_in_the_page_query(self):
+        url = reverse('admin:tgbot_complaint_changelist')
+        self.create(2, 1)
+        few = self.queries(url)
+        self.create(20, 2)
+
+        many = self.queries(url)
+        self.assertEqual(len(many), len(few))
+        self.assertContains(self.client.get(url), '<td class="field-media_count">2</td>', count=20, html=True)
+
+    def test_change_view_reads_media_once(self):
+        [one] = self.create(1, 1)
+        [ten] = self.create(1, 10)
+
+        self.queries(reverse('admin:tgbot_complaint_change', args=[one.pk]))  # warm the content type cache
+        few = self.queries(reverse('admin:tgbot_complaint_change', args=[one.pk]))
+        many = self.queries(reverse('admin:tgbot_complaint_change', args=[ten.pk]))
+
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(len([sql for sql in many if sql.startswith('SELECT "tgbot_complaintmedia"')]), 1)
+
+    def test_media_list_is_escaped(self):
+        [complaint] = self.create(1, 1)
+        ComplaintMedia.objects.update(file_id='<script>')
+
+        response = self.client.get(reverse('admin:tgbot_complaint_change', args=[complaint.pk]))
+
+        self.assertNotContains(response, '<li>Photo: <script>')
+        self.assertContains(response, '<li>Photo: &lt;script&gt;</li>')
+
+
+class FakeSession(BaseSession):
+    """Bot API session that records calls instead of calling Telegram."""
+
+    def __init__(self, blocked=(), flood=(), hang=()):
+        super().__init__()
+        self.blocked = set(blocked)
+        self.flood = set(flood)
+        self.hang = set(hang)
+        self.calls = []
+        self.sent = []
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(type(method).__name__)
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id in self.hang:
+            await asyncio.Event().wait()
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(method=method, message='Forbidden: bot was blocked by the user')
+        if chat_id in self.flood:
+            self.flood.discard(chat_id)
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=1)
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"photos/{method.file_id}.jpg")
+        if method.__returning__ is not Message:
+            return True
+        if isinstance(method, SendMessage):
+            self.sent.append(chat_id)
+        return Message(
+            message_id=len(self.calls), date=datetime.now(), chat=Chat(id=chat_id or 0, type='private'),
+            text=getattr(method, 'text', None)
+        ).as_(bot)
+
+
+class BroadcastTests(TransactionTestCase):
+
+    def setUp(self):
+        self.users = [TelegramUser.objects.create(telegram_id=1000 + i) for i in range(6)]
+        TelegramUser.objects.create(telegram_id=999, is_blocked=True)
+        self.limiter = broadcast.RateLimiter(rate=1000)
+
+    def run_broadcast(self, record, session, **kwargs):
+        bot = Bot('1:a', session=session)
+        kwargs = {'limiter': self.limiter, 'concurrency': 3, 'batch_size': 2, **kwargs}
+        return async_to_sync(broadcast.Broadcast(bot, record, **kwargs).run)()
+
+    def test_every_active_user_gets_the_message_once(self):
+        record = repository.create_broadcast(text='Salom', created_by='admin', chat_id=1)
+        session = FakeSession(blocked=[1001, 1004])
+
+        self.run_broadcast(record, session)
+
+        self.assertEqual(sorted(session.sent), [1000, 1002, 1003, 1005])
+        record.refresh_from_db()
+        self.assertEqual((record.total_count, record.sent_count, record.failed_count), (6, 4, 2))
+        self.assertEqual(record.last_user_id, self.users[-1].pk)
+        self.assertIsNotNone(record.completed_at)
+        self.assertEqual(
+            set(TelegramUser.objects.filter(is_blocked=True).values_list('telegram_id', flat=True)),
+            {999, 1001, 1004}
+        )
+
+    def test_flood_control_pauses_every_send_and_retries(self):
+        record = repository.create_broadcast(text='Salom', created_by='admin', chat_id=1)
+        session = FakeSession(flood=[1002])
+
+        started = timezone.now()
+        self.run_broadcast(record, session)
+
+        self.assertGreaterEqual((timezone.now() - started).total_seconds(), 1)
+        self.assertEqual(self.limiter.pauses, 1)
+        self.assertEqual(sorted(session.sent), [user.telegram_id for user in self.users])
+
+    def test_resume_starts_after_the_checkpoint(self):
+        record = repository.create_broadcast(text='Salom', created_by='admin', chat_id=1)
+        repository.checkpoint_broadcast(record.pk, self.users[2].pk, 2, 1)
+        record.refresh_from_db()
+        session = FakeSession()
+
+        self.run_broadcast(record, session)
+
+        self.assertEqual(session.sent, [1003, 1004, 1005])
+        record.refresh_from_db()
+        self.assertEqual((record.sent_count, record.failed_count), (5, 1))
+        self.assertIsNotNone(record.completed_at)
+
+    def test_stopped_broadcast_keeps_the_finished_prefix(self):
+        record = repository.create_broadcast(text='Salom', created_by='admin', chat_id=1)
+        session = FakeSession(hang=[1003])
+        bot = Bot('1:a', session=session)
+
+        async def run_and_stop():
+            task = asyncio.ensure_future(
+                broadcast.Broadcast(bot, record, limiter=self.limiter, concurrency=2, batch_size=2).run()
+            )
+            while len(session.sent) < 5:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        async_to_sync(run_and_stop)()
+
+        self.assertEqual(sorted(session.sent), [1000, 1001, 1002, 1004, 1005])
+        record.refresh_from_db()
+        # 1004 and 1005 come after the stuck user, so they are not covered yet
+        self.assertEqual((record.last_user_id, record.sent_count), (self.users[2].pk, 3))
+        self.assertIsNone(record.completed_at)
+        self.assertEqual(async_to_sync(repository.unfinished_broadcasts)(), [record])
+
+    def test_stale_checkpoint_is_ignored(self):
+        record = repository.create_broadcast(text='Salom', created_by='admin', chat_id=1)
+        repository.checkpoint_broadcast(record.pk, self.users[3].pk, 4, 0)
+        repository.checkpoint_broadcast(record.pk, self.users[1].pk, 2, 0)
+
+        record.refresh_from_db()
+        self.assertEqual((record.last_user_id, record.sent_count), (self.users[3].pk, 4))
+
+    def test_rate_limiter_spaces_sends_and_pauses(self):
+        limiter = broadcast.RateLimiter(rate=10, burst=2)
+
+        self.assertEqual([round(limiter.reserve(now=0), 3) for _ in range(4)], [0, 0, 0.1, 0.2])
+        limiter.pause(5, now=0)
+        self.assertEqual(limiter.reserve(now=0), 5)
+
+
+@contextmanager
+def capture_statements():
+    """SQL run on any thread - the bot's ORM work runs on the repository's pool.
+
+    Transaction control (BEGIN, savepoints) is left out.
+    """
+    statements = []
+    execute = CursorWrapper._execute_with_wrappers
+
+    def counted(self, sql, params, many, executor):
+        if not sql.startswith(('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            statements.append(sql)
+        return execute(self, sql, params, many, executor)
+
+    with mock.patch.object(CursorWrapper, '_execute_with_wrappers', counted):
+        yield statements
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id, text=None, **kwargs):
+    return Update(update_id=next(_update_ids), message=Message(
+        message_id=next(_update_ids), date=datetime.now(), chat=Chat(id=user_id, type='private'),
+        from_user=TgUser(id=user_id, is_bot=False, first_name='Ali', username=f"user{user_id}"), text=text, **kwargs
+    ))
+
+
+def callback_update(user_id, data):
+    message = Message(message_id=next(_update_ids), date=datetime.now(), chat=Chat(id=user_id, type='private'), text='-')
+    return Update(update_id=next(_update_ids), callback_query=CallbackQuery(
+        id=str(next(_update_ids)), from_user=TgUser(id=user_id, is_bot=False, first_name='Ali'),
+        chat_instance='1', data=data, message=message
+    ))
+
+
+def bot_dispatcher():
+    """The bot's dispatcher wired the way runbot does, without throttling."""
+    from tgbot.bot.handlers.errors import error_handler
+    from tgbot.bot.handlers.users import admin, complaint, start
+
+    if not dp.sub_routers:
+        dp.update.outer_middleware(DatabaseConnectionMiddleware())
+        dp.update.outer_middleware(TelegramUserMiddleware(user_cache))
+        for router in (start.router, complaint.router, admin.router, error_handler.router):
+            dp.include_router(router)
+    return dp
+
+
+COMPLAINT_STEPS = [
+    ('start_complaint', lambda user_id: message_update(user_id, "📝 Shikoyat yuborish")),
+    ('anonymity', lambda user_id: message_update(user_id, "Mening ma'lumotlarim bilan ✅")),
+    ('full_name', lambda user_id: message_update(user_id, "Ali Valiyev")),
+    ('phone', lambda user_id: message_update(user_id, "+998901234567")),
+    ('region', lambda user_id: callback_update(user_id, "region_1")),
+    ('district', lambda user_id: callback_update(user_id, "district_15")),
+    ('mahalla', lambda user_id: callback_update(user_id, "mahalla_1")),
+    ('target_name', lambda user_id: message_update(user_id, "Bek Bekov")),
+    ('target_position', lambda user_id: message_update(user_id, "Boshliq")),
+    ('target_organization', lambda user_id: message_update(user_id, "Hokimiyat")),
+    ('text', lambda user_id: message_update(user_id, "x" * 40)),
+    ('photo', lambda user_id: message_update(
+        user_id, photo=[PhotoSize(file_id='photo', file_unique_id='photo', width=1, height=1)]
+    )),
+    ('finish_media', lambda user_id: message_update(user_id, "✅ Tugatish")),
+    ('confirm', lambda user_id: message_update(user_id, "✅ Yuborish")),
+]
+
+
+class ComplaintFlowQueryTests(TransactionTestCase):
+    """Statements per step of a complete complaint, from /start to confirmation."""
+
+    user_id = 5
+
+    def setUp(self):
+        self.dispatcher = bot_dispatcher()
+        user_cache.invalidate(self.user_id)
+        self.session = FakeSession()
+        patcher = mock.patch.object(bot, 'session', self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_steps(self, steps):
+        async def feed():
+            counts = {}
+            for name, make_update in steps:
+                with capture_statements() as statements:
+                    await self.dispatcher.feed_update(bot, make_update(self.user_id))
+                counts[name] = len(statements)
+            return counts
+        return async_to_sync(feed)()
+
+    def test_complaint_flow_query_count(self):
+        counts = self.run_steps([
+            ('start', lambda user_id: message_update(user_id, "/start")),
+            ('language', lambda user_id: message_update(user_id, "O'zbekcha 🇺🇿")),
+            *COMPLAINT_STEPS,
+        ])
+
+        self.assertEqual(counts, {
+            # Cache miss, then the upsert
+            'start': 2,
+            'language': 1,
+            **{name: 0 for name, _ in COMPLAINT_STEPS[:-1]},
+            # Month counter, complaint, daily rollup, media
+            'confirm': 4,
+        })
+        complaint = Complaint.objects.get()
+        self.assertEqual(complaint.user.telegram_id, self.user_id)
+        self.assertEqual(complaint.media_files.count(), 1)
+
+    def test_returning_user_complaint_costs_only_the_save(self):
+        self.run_steps([
+            ('start', lambda user_id: message_update(user_id, "/start")),
+            ('language', lambda user_id: message_update(user_id, "O'zbekcha 🇺🇿")),
+        ])
+
+        counts = self.run_steps(COMPLAINT_STEPS)
+
+        self.assertEqual(sum(counts.values()), 4)
+        self.assertEqual(Complaint.objects.count(), 1)
+
+
+class ComplaintAlbumTests(TransactionTestCase):
+    """Album files arrive as separate updates and are saved together."""
+
+    user_id = 6
+    album_size = 4
+
+    def setUp(self):
+        from tgbot.bot.handlers.users import complaint
+
+        self.complaint = complaint
+        self.dispatcher = bot_dispatcher()
+        user_cache.invalidate(self.user_id)
+        self.session = FakeSession()
+        for patcher in (
+            mock.patch.object(bot, 'session', self.session),
+            mock.patch.object(complaint, 'ALBUM_WINDOW', 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        async def walk_to_media_step():
+            steps = [
+                lambda user_id: message_update(user_id, "/start"),
+                lambda user_id: message_update(user_id, "O'zbekcha 🇺🇿"),
+                *(make_update for name, make_update in itertools.takewhile(
+                    lambda step: step[0] != 'photo', COMPLAINT_STEPS
+                )),
+            ]
+            for make_update in steps:
+                await self.dispatcher.feed_update(bot, make_update(self.user_id))
+        async_to_sync(walk_to_media_step)()
+
+    def feed(self, texts):
+        async def feed():
+            for text in texts:
+                await self.dispatcher.feed_update(bot, message_update(self.user_id, text))
+        async_to_sync(feed)()
+
+    def run_album(self, after_album=()):
+        """Send one album at the media step, then ``after_album`` before it is flushed.
+
+        The buffering window stays open until every update has been handled.
+        Returns the FSM data writes and the messages sent until the flush is done.
+        """
+        storage = self.dispatcher.fsm.storage
+        flush_album = self.complaint.flush_album
+
+        async def feed():
+            window = asyncio.Event()
+
+            async def flush_after_window(*args):
+                await window.wait()
+                await flush_album(*args)
+
+            sent_before = self.session.calls.count('SendMessage')
+            with mock.patch.object(self.complaint, 'flush_album', flush_after_window), \
+                    mock.patch.object(storage, 'set_data', wraps=storage.set_data) as set_data:
+                for i in range(self.album_size):
+                    await self.dispatcher.feed_update(bot, message_update(
+                        self.user_id, media_group_id='album',
+                        photo=[PhotoSize(file_id=f'photo{i}', file_unique_id=f'photo{i}', width=1, height=1)],
+                    ))
+                for text in after_album:
+                    await self.dispatcher.feed_update(bot, message_update(self.user_id, text))
+                window.set()
+                await asyncio.gather(*self.complaint._album_tasks)
+            return set_data.call_count, self.session.calls.count('SendMessage') - sent_before
+
+        return async_to_sync(feed)()
+
+    def saved_file_ids(self):
+        return sorted(Complaint.objects.get().media_files.values_list('file_id', flat=True))
+
+    def test_album_is_saved_with_one_write_and_one_acknowledgement(self):
+        writes, messages = self.run_album()
+        self.feed(["✅ Tugatish", "✅ Yuborish"])
+
+        self.assertEqual((writes, messages), (1, 1))
+        self.assertEqual(self.saved_file_ids(), [f'photo{i}' for i in range(self.album_size)])
+
+    def test_finish_before_the_flush_keeps_the_whole_album(self):
+        self.run_album(after_album=["✅ Tugatish", "✅ Yuborish"])
+
+        self.assertEqual(self.saved_file_ids(), [f'photo{i}' for i in range(self.album_size)])